@@ -1,40 +1,116 @@
 import os
+import io
+import csv
 import time
+import tempfile
+import atexit
+import base64
+import binascii
+import codecs
 import random
 import sqlite3
 import datetime
 import secrets
+import json
+import hashlib
 import threading
+import uuid
+import queue
+import heapq
+import socket
 import smtplib
-import schedule
-import qrcode
+import click
+import openpyxl
 import pandas as pd
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from werkzeug.utils import secure_filename
 
-from flask import Flask, render_template, request, redirect, url_for, flash, g, send_from_directory
+from qr_lotes import generar_qr, generar_lote, hash_qr, codificar_qr, generar_pdf_etiquetas, PAPELES
+
+from flask import Flask, render_template, request, redirect, url_for, flash, g, jsonify, abort, Response, has_app_context, send_file, stream_with_context
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, TextAreaField, DateField, IntegerField, SelectField, FileField
 from wtforms.validators import DataRequired, Length, EqualTo, Email
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from jinja2 import TemplateNotFound
 
 # Configuración de la aplicación
 app = Flask(__name__)
+app.config['DB_PATH'] = 'archivo.db'
+# Conexiones SQLite reutilizables entre peticiones e hilos de segundo plano
+app.config['DB_POOL_MAX'] = 8
+app.config['DB_BUSY_TIMEOUT_MS'] = 5000
 app.secret_key = "una_clave_secreta_muy_segura"  # Cambia esto en producción
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max-limit para archivos
+app.config['MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024  # 512MB max-limit para archivos (la importación se lee por streaming)
+app.config['SUBIDA_TAMANO_BLOQUE'] = 1024 * 1024  # bloques de 1MB al copiar cargas a disco
 app.config['UPLOAD_FOLDER'] = 'uploads'
+# Caché del usuario de la sesión: evita consultar users en cada petición
+app.config['USUARIOS_CACHE_SEGUNDOS'] = 60
+app.config['USUARIOS_CACHE_ENTRADAS'] = 1024
+# Hash de contraseñas: método de werkzeug ("scrypt:N:r:p" o "pbkdf2:sha256:iteraciones").
+# Al iniciar sesión, los hashes guardados con otro método se vuelven a generar con este.
+app.config['PASSWORD_METODO'] = os.environ.get('PASSWORD_METODO', 'scrypt:32768:8:1')
+# Hashes calculados a la vez; el resto de los inicios de sesión espera su turno
+app.config['PASSWORD_HILOS'] = int(os.environ.get('PASSWORD_HILOS', 2))
+# Tiempo máximo para contar resultados de búsqueda antes de mostrar un total aproximado
+app.config['CONTEO_PRESUPUESTO_SEGUNDOS'] = 0.25
+# Importación de Excel en segundo plano
+app.config['IMPORTACION_TAMANO_LOTE'] = 1000
+app.config['TRABAJOS_MAX_HILOS'] = 1
+# Un trabajo sin avances durante este tiempo se da por interrumpido al arrancar
+app.config['TRABAJOS_INACTIVO_MINUTOS'] = 10
+# Procesos para generar códigos QR por lotes (None = número de CPUs)
+app.config['QR_PROCESOS'] = None
+# Servir los QR desde memoria (/qr/<id_caja>.png) en lugar de escribir un PNG por caja en static/
+app.config['QR_EN_MEMORIA'] = True
+app.config['QR_CACHE_ENTRADAS'] = 4096
+# Portadas renderizadas que se guardan en la base (las menos usadas se descartan)
+app.config['PORTADAS_CACHE_ENTRADAS'] = 2000
+# Al leer una portada guardada, su hora de uso solo se actualiza si es más antigua que
+# esto: así las consultas repetidas no escriben en la base
+app.config['PORTADAS_USO_REFRESCO_SEGUNDOS'] = 3600
+# Hojas de etiquetas en PDF (valores por defecto; el formulario puede cambiarlos)
+app.config['ETIQUETAS_PAPEL'] = 'A4'
+app.config['ETIQUETAS_COLUMNAS'] = 3
+app.config['ETIQUETAS_FILAS'] = 8
+app.config['ETIQUETAS_MARGEN_MM'] = 8.0
+app.config['ETIQUETAS_DPI'] = 200
+# Correo saliente. Para pruebas locales basta un servidor de depuración, por ejemplo
+#   python -m aiosmtpd -n -l localhost:8025
+# con SMTP_SERVIDOR=localhost SMTP_PUERTO=8025 SMTP_STARTTLS=0 y SMTP_USUARIO vacío.
+app.config['SMTP_SERVIDOR'] = os.environ.get('SMTP_SERVIDOR', 'smtp.example.com')  # Configura tu servidor SMTP
+app.config['SMTP_PUERTO'] = int(os.environ.get('SMTP_PUERTO', 587))
+app.config['SMTP_USUARIO'] = os.environ.get('SMTP_USUARIO', 'tu_email@example.com')
+app.config['SMTP_PASSWORD'] = os.environ.get('SMTP_PASSWORD', 'tu_password')
+app.config['SMTP_REMITENTE'] = os.environ.get('SMTP_REMITENTE', app.config['SMTP_USUARIO'] or 'guazinibox@localhost')
+app.config['SMTP_STARTTLS'] = os.environ.get('SMTP_STARTTLS', '1') != '0'
+app.config['SMTP_TIMEOUT'] = 30
+# Sesiones SMTP simultáneas al enviar un lote y reintentos por mensaje
+app.config['SMTP_HILOS'] = 2
+app.config['SMTP_REINTENTOS'] = 3
+app.config['SMTP_ESPERA_REINTENTO'] = 2.0  # segundos; se duplica en cada intento
+# Bandeja de salida de notificaciones
+app.config['OUTBOX_LOTE'] = 200
+app.config['OUTBOX_MAX_INTENTOS'] = 5
+app.config['LIDER_ARRENDAMIENTO_SEGUNDOS'] = 300
+# Días entre recordatorios de un mismo préstamo vencido
+app.config['AVISO_INTERVALO_DIAS'] = 7
+# Planificador de tareas periódicas (ver /admin/jobs)
+app.config['PLANIFICADOR_ACTIVO'] = True
+
+# Con 'python app.py', los procesos que multiprocessing arranca con 'spawn' (el pool
+# de qr_lotes) vuelven a ejecutar este script como __mp_main__. En ellos se omite la
+# inicialización con efectos sobre la base (tablas, migraciones, trabajos).
+PROCESO_AUXILIAR = __name__ == "__mp_main__"
 
 # Crear directorio de uploads si no existe
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
-# Crear directorio para archivos exportados si no existe
-EXPORT_FOLDER = 'exports'
-if not os.path.exists(EXPORT_FOLDER):
-    os.makedirs(EXPORT_FOLDER)
-
 # Configuración de Flask-Login
 login_manager = LoginManager()
 login_manager.login_view = "login"
@@ -48,11 +124,111 @@ if not os.path.exists(QR_DIR):
 # ========================================================
 # Funciones de Base de Datos y creación de tablas
 # ========================================================
-def get_db_connection():
-    conn = sqlite3.connect("archivo.db")
+# Las funciones de ayuda siguen el patrón "conn = get_db_connection() ... conn.close()".
+# En lugar de abrir un archivo nuevo cada vez:
+#   - dentro de una petición (o comando CLI) todas comparten una conexión guardada
+#     en flask.g, que vuelve al pool al terminar el contexto;
+#   - fuera de contexto (hilos de importación, QR, notificaciones) cada llamada toma
+#     una conexión del pool.
+# close() no cierra el archivo: deshace lo que no se haya confirmado (igual que al
+# cerrar una conexión de verdad) y la devuelve a su dueño.
+
+class ConexionArchivo(sqlite3.Connection):
+    """Conexión reutilizable cuyo close() la libera en vez de cerrarla."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.usos = 0
+        self.de_peticion = False
+
+    def close(self):
+        self.usos = max(self.usos - 1, 0)
+        if self.usos:
+            # Una función anidada terminó; la conexión la sigue usando quien la llamó
+            return
+        if self.in_transaction:
+            self.rollback()
+        if not self.de_peticion:
+            _devolver_al_pool(self)
+
+    def cerrar(self):
+        super().close()
+
+_pool_conexiones = queue.LifoQueue()
+
+def _abrir_conexion():
+    conn = sqlite3.connect(app.config['DB_PATH'], factory=ConexionArchivo,
+                           timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000,
+                           check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL permite lectores concurrentes mientras hay un escritor
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+    conn.execute("PRAGMA cache_size = -20000")  # ~20MB de páginas en caché
+    conn.execute("PRAGMA mmap_size = 268435456")  # 256MB
+    conn.execute("PRAGMA temp_store = MEMORY")
     return conn
 
+def _tomar_del_pool():
+    try:
+        return _pool_conexiones.get_nowait()
+    except queue.Empty:
+        return _abrir_conexion()
+
+def _devolver_al_pool(conn):
+    if _pool_conexiones.qsize() >= app.config['DB_POOL_MAX']:
+        conn.cerrar()
+    else:
+        _pool_conexiones.put(conn)
+
+def vaciar_pool():
+    """Cierra las conexiones libres del pool."""
+    while True:
+        try:
+            _pool_conexiones.get_nowait().cerrar()
+        except queue.Empty:
+            return
+
+# Conexiones heredadas del proceso padre al hacer fork. SQLite no admite usar (ni
+# cerrar) en el hijo una conexión abierta antes del fork, así que solo se guardan
+# para que el recolector de basura no las cierre.
+_conexiones_heredadas = []
+
+def _reiniciar_pool_en_hijo():
+    global _pool_conexiones
+    while True:
+        try:
+            _conexiones_heredadas.append(_pool_conexiones.get_nowait())
+        except queue.Empty:
+            break
+    _pool_conexiones = queue.LifoQueue()
+
+# Los servidores con varios procesos (gunicorn, uwsgi) importan la app y luego hacen
+# fork: cada proceso hijo empieza con un pool vacío y abre sus propias conexiones.
+os.register_at_fork(after_in_child=_reiniciar_pool_en_hijo)
+
+def get_db_connection():
+    if has_app_context():
+        conn = g.get('_db')
+        if conn is None:
+            conn = g._db = _tomar_del_pool()
+            conn.de_peticion = True
+    else:
+        conn = _tomar_del_pool()
+    conn.usos += 1
+    return conn
+
+@app.teardown_appcontext
+def liberar_conexion(exc):
+    conn = g.pop('_db', None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.usos = 0
+        conn.de_peticion = False
+        _devolver_al_pool(conn)
+
 def create_tables():
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -114,12 +290,25 @@ def create_tables():
             fila TEXT,
             columna TEXT,
             qr_path TEXT,
+            numero_caja INTEGER,
             FOREIGN KEY(departamento_id) REFERENCES departamentos(id),
             FOREIGN KEY(tipo_id) REFERENCES tipos(id),
             FOREIGN KEY(bodega_id) REFERENCES bodegas(id),
             FOREIGN KEY(ubicacion_id) REFERENCES ubicaciones(id)
         )
     """)
+    # Cajas cuyo id_caja cambió al migrar (repetido o no numérico). El id_caja va
+    # impreso en etiquetas y QR ya pegados, así que se guarda para reetiquetarlas.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cajas_renumeradas (
+            caja_id INTEGER PRIMARY KEY,
+            id_caja_anterior TEXT,
+            id_caja_nuevo TEXT NOT NULL,
+            motivo TEXT NOT NULL,
+            fecha TEXT NOT NULL,
+            FOREIGN KEY(caja_id) REFERENCES cajas(id)
+        )
+    """)
     # Tabla de préstamos
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS prestamos (
@@ -131,18 +320,391 @@ def create_tables():
             returned INTEGER DEFAULT 0,
             returned_date TEXT,
             email TEXT,
+            ultimo_aviso TEXT,
+            proximo_aviso TEXT,
             FOREIGN KEY(caja_id) REFERENCES cajas(id)
         )
     """)
+    # Trabajos en segundo plano (importaciones de Excel)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trabajos (
+            id TEXT PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            usuario_id INTEGER,
+            total_filas INTEGER,
+            filas_leidas INTEGER NOT NULL DEFAULT 0,
+            insertadas INTEGER NOT NULL DEFAULT 0,
+            rechazadas INTEGER NOT NULL DEFAULT 0,
+            mensaje TEXT,
+            cancelar INTEGER NOT NULL DEFAULT 0,
+            creado TEXT,
+            iniciado TEXT,
+            actualizado TEXT
+        )
+    """)
+    # Manifiesto de códigos QR: hash del contenido al que apunta cada caja
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS qr_manifiesto (
+            caja_id INTEGER PRIMARY KEY,
+            hash TEXT NOT NULL,
+            actualizado TEXT,
+            FOREIGN KEY(caja_id) REFERENCES cajas(id)
+        )
+    """)
+    # Cambiar lo que se imprime en el QR invalida la entrada del manifiesto
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS qr_manifiesto_update
+        AFTER UPDATE OF id_caja, codigo_caja, departamento_id, tipo_id ON cajas BEGIN
+            DELETE FROM qr_manifiesto WHERE caja_id = OLD.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS qr_manifiesto_delete AFTER DELETE ON cajas BEGIN
+            DELETE FROM qr_manifiesto WHERE caja_id = OLD.id;
+        END
+    """)
+    # Portadas ya renderizadas; clave = versión de la fila + plantilla + fecha de la plantilla
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS portadas_cache (
+            caja_id INTEGER PRIMARY KEY,
+            clave TEXT NOT NULL,
+            html TEXT NOT NULL,
+            usado REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY(caja_id) REFERENCES cajas(id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS portadas_cache_delete AFTER DELETE ON cajas BEGIN
+            DELETE FROM portadas_cache WHERE caja_id = OLD.id;
+        END
+    """)
+    # Bandeja de salida de notificaciones: un aviso por préstamo y día
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prestamo_id INTEGER NOT NULL,
+            fecha TEXT NOT NULL,
+            destinatario TEXT NOT NULL,
+            id_caja TEXT,
+            due_date TEXT,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            proximo_intento TEXT,
+            ultimo_error TEXT,
+            creado TEXT,
+            reclamado_en TEXT,
+            enviado TEXT,
+            UNIQUE(prestamo_id, fecha),
+            FOREIGN KEY(prestamo_id) REFERENCES prestamos(id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_estado ON outbox(estado, destinatario)")
+    # Arrendamientos: quién es el líder de una tarea y hasta cuándo
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS arrendamientos (
+            nombre TEXT PRIMARY KEY,
+            duenio TEXT NOT NULL,
+            vence REAL NOT NULL
+        )
+    """)
+    # Estado de las tareas del planificador, compartido entre procesos
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tareas_programadas (
+            nombre TEXT PRIMARY KEY,
+            ultima_ejecucion TEXT,
+            duracion REAL,
+            resultado TEXT,
+            ultimo_error TEXT,
+            ejecuciones INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Metadatos de la aplicación (contadores de generación, etc.)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS metadatos (
+            clave TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO metadatos (clave, valor) VALUES ('cajas_generacion', 0)")
+    # Toda escritura en cajas (formulario, importación, limpiar_base) invalida los conteos en caché
+    for evento in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS cajas_generacion_{evento.lower()} AFTER {evento} ON cajas BEGIN
+                UPDATE metadatos SET valor = valor + 1 WHERE clave = 'cajas_generacion';
+            END
+        """)
+    # Los nombres de catálogo también forman parte de la búsqueda
+    for tabla in ("departamentos", "tipos", "bodegas", "ubicaciones"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {tabla}_generacion_update AFTER UPDATE OF nombre ON {tabla} BEGIN
+                UPDATE metadatos SET valor = valor + 1 WHERE clave = 'cajas_generacion';
+            END
+        """)
+    # Versión de los catálogos: avisa a todos los procesos que su caché quedó obsoleta
+    cursor.execute("INSERT OR IGNORE INTO metadatos (clave, valor) VALUES ('catalogos_version', 0)")
+    for tabla in ("departamentos", "tipos", "bodegas", "ubicaciones"):
+        for evento in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {tabla}_catalogo_{evento.lower()} AFTER {evento} ON {tabla} BEGIN
+                    UPDATE metadatos SET valor = valor + 1 WHERE clave = 'catalogos_version';
+                END
+            """)
+    fts_disponible = crear_indice_busqueda(cursor)
     conn.commit()
+    aplicar_migraciones(conn)
     conn.close()
+    return fts_disponible
 
-create_tables()
+# ========================================================
+# Migraciones versionadas del esquema (PRAGMA user_version)
+# ========================================================
+def _asignar_numeros_caja(cursor):
+    """Llena numero_caja a partir de id_caja sin violar el índice único.
+    Las cajas cuyo id_caja no es un número entero o repite el de otra caja (la
+    más antigua conserva el suyo) reciben un número nuevo después del mayor. Cada
+    cambio queda en cajas_renumeradas (ver el comando cajas-renumeradas) para
+    poder reetiquetar las cajas físicas."""
+    usados = set()
+    asignados, a_renumerar = [], []
+    for fila in cursor.execute(
+        "SELECT id, id_caja, numero_caja FROM cajas WHERE id_caja IS NOT NULL ORDER BY id"
+    ).fetchall():
+        numero = fila['numero_caja']
+        if numero is None:
+            texto = str(fila['id_caja']).strip()
+            numero = int(texto) if texto.isdigit() else None
+        if numero is None or numero in usados:
+            a_renumerar.append(fila)
+        else:
+            usados.add(numero)
+            if fila['numero_caja'] is None:
+                asignados.append((numero, fila['id']))
+    cursor.executemany("UPDATE cajas SET numero_caja = ? WHERE id = ?", asignados)
+    siguiente = max(usados, default=0) + 1
+    fecha = datetime.datetime.now().isoformat(timespec="seconds")
+    for fila in a_renumerar:
+        nuevo = str(siguiente).zfill(5)
+        texto = str(fila['id_caja']).strip()
+        motivo = "repetido" if texto.isdigit() else "no numérico"
+        cursor.execute("UPDATE cajas SET numero_caja = ?, id_caja = ? WHERE id = ?", (siguiente, nuevo, fila['id']))
+        # En la misma transacción que el cambio: si la migración falla, no queda ninguno de los dos
+        cursor.execute(
+            "INSERT OR REPLACE INTO cajas_renumeradas (caja_id, id_caja_anterior, id_caja_nuevo, motivo, fecha) "
+            "VALUES (?, ?, ?, ?, ?)", (fila['id'], fila['id_caja'], nuevo, motivo, fecha))
+        siguiente += 1
+    if a_renumerar:
+        print(f"{len(a_renumerar)} cajas con id_caja repetido o no numérico recibieron uno nuevo. "
+              f"Hay que reetiquetarlas: 'flask cajas-renumeradas --csv archivo.csv' las lista.")
+
+def _migracion_numero_caja_e_indices(cursor):
+    """Columna numero_caja e índices para claves foráneas y filtros.
+    numero_caja es la versión entera y única de id_caja; con ella el orden, los
+    rangos y el siguiente número se resuelven con un índice en lugar de CAST."""
+    columnas = [col['name'] for col in cursor.execute("PRAGMA table_info(cajas)").fetchall()]
+    if 'numero_caja' not in columnas:
+        cursor.execute("ALTER TABLE cajas ADD COLUMN numero_caja INTEGER")
+    _asignar_numeros_caja(cursor)
+    # Reemplazado por idx_cajas_numero (numero_caja, id implícito en el índice)
+    cursor.execute("DROP INDEX IF EXISTS idx_cajas_orden")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_cajas_numero ON cajas(numero_caja)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cajas_id_caja ON cajas(id_caja)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cajas_departamento ON cajas(departamento_id, numero_caja)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cajas_tipo ON cajas(tipo_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cajas_bodega ON cajas(bodega_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cajas_ubicacion ON cajas(ubicacion_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prestamos_caja ON prestamos(caja_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prestamos_vencimiento ON prestamos(returned, due_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_reset_token ON users(reset_token)")
+    cursor.execute("ANALYZE")
+
+# (versión, función); cada migración se ejecuta una sola vez y en orden
+def _migracion_secuencias(cursor):
+    """Tabla secuencias para asignar números de caja sin carreras.
+    Se inicializa con el mayor numero_caja existente."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS secuencias (
+            nombre TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO secuencias (nombre, valor)
+        SELECT 'numero_caja', COALESCE(MAX(numero_caja), 0) FROM cajas
+    """)
+
+def _migracion_avisos_prestamos(cursor):
+    """Columnas ultimo_aviso y proximo_aviso en prestamos.
+    proximo_aviso es la fecha desde la que el préstamo necesita un aviso; los triggers
+    la fijan al día siguiente del vencimiento y la borran al devolverlo, y cada aviso
+    la mueve AVISO_INTERVALO_DIAS hacia adelante. Así la tarea diaria solo lee, por
+    índice, los préstamos que recién vencieron o a los que les toca recordatorio."""
+    columnas = [col['name'] for col in cursor.execute("PRAGMA table_info(prestamos)").fetchall()]
+    for columna in ("ultimo_aviso", "proximo_aviso"):
+        if columna not in columnas:
+            cursor.execute(f"ALTER TABLE prestamos ADD COLUMN {columna} TEXT")
+    cursor.execute("""
+        UPDATE prestamos SET proximo_aviso = date(due_date, '+1 day')
+        WHERE returned = 0 AND proximo_aviso IS NULL
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prestamos_proximo_aviso ON prestamos(returned, proximo_aviso)")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS prestamos_aviso_insert AFTER INSERT ON prestamos
+        WHEN NEW.returned = 0 BEGIN
+            UPDATE prestamos SET proximo_aviso = date(NEW.due_date, '+1 day') WHERE id = NEW.id;
+        END
+    """)
+    # Solo si cambia la fecha límite o la devolución; editar otros campos no reinicia los avisos
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS prestamos_aviso_update AFTER UPDATE OF due_date, returned ON prestamos
+        WHEN NEW.due_date IS NOT OLD.due_date OR NEW.returned IS NOT OLD.returned BEGIN
+            UPDATE prestamos SET proximo_aviso = CASE WHEN NEW.returned = 0
+                THEN date(NEW.due_date, '+1 day') END
+            WHERE id = NEW.id;
+        END
+    """)
+
+def _migracion_indices_prestamos(cursor):
+    """Índices para filtrar el listado de préstamos sin recorrer el historial.
+    idx_prestamos_devuelto lleva el id implícito, así que "sin devolver" y
+    "devueltos" salen ya en orden de id para la paginación por cursor."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prestamos_devuelto ON prestamos(returned)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prestamos_fecha ON prestamos(loan_date)")
+
+def _migracion_portadas_acotadas(cursor):
+    """Caché de portadas acotada a PORTADAS_CACHE_ENTRADAS filas.
+    La columna usado permite descartar las portadas menos consultadas. Se vacían las
+    que dejó el precalentado nocturno de todas las cajas: se vuelven a guardar a
+    medida que se piden, y el VACUUM semanal devuelve el espacio."""
+    columnas = [col['name'] for col in cursor.execute("PRAGMA table_info(portadas_cache)").fetchall()]
+    if "usado" not in columnas:
+        cursor.execute("ALTER TABLE portadas_cache ADD COLUMN usado REAL NOT NULL DEFAULT 0")
+    cursor.execute("DELETE FROM portadas_cache")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_portadas_cache_usado ON portadas_cache(usado)")
+
+MIGRACIONES = [
+    (1, _migracion_numero_caja_e_indices),
+    (2, _migracion_secuencias),
+    (3, _migracion_avisos_prestamos),
+    (4, _migracion_indices_prestamos),
+    (5, _migracion_portadas_acotadas),
+]
+
+def aplicar_migraciones(conn):
+    """Ejecuta las migraciones pendientes según PRAGMA user_version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for numero, migracion in MIGRACIONES:
+        if numero <= version:
+            continue
+        print(f"Aplicando migración {numero}: {migracion.__doc__.splitlines()[0]}")
+        try:
+            migracion(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {numero}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+# ========================================================
+# Índice de búsqueda de texto completo (SQLite FTS5)
+# ========================================================
+# Catálogos desnormalizados en el índice: (tabla, columna FK en cajas, columna en cajas_fts)
+CATALOGOS_BUSQUEDA = [
+    ("departamentos", "departamento_id", "departamento"),
+    ("tipos", "tipo_id", "tipo"),
+    ("bodegas", "bodega_id", "bodega"),
+    ("ubicaciones", "ubicacion_id", "ubicacion"),
+]
+
+def _valores_fila_fts(alias):
+    """Expresiones SQL con los valores indexados de una caja (alias NEW o cajas)."""
+    catalogos = ", ".join(f"(SELECT nombre FROM {tabla} WHERE id = {alias}.{fk})"
+                          for tabla, fk, _ in CATALOGOS_BUSQUEDA)
+    return (f"{alias}.id, {alias}.id_caja, {alias}.codigo_caja, {alias}.años, {alias}.observacion, "
+            f"{alias}.descripcion, {alias}.percha, {alias}.fila, {alias}.columna, {catalogos}")
+
+COLUMNAS_FTS = ("rowid, id_caja, codigo_caja, años, observacion, descripcion, percha, fila, columna, "
+                "departamento, tipo, bodega, ubicacion")
+
+def crear_indice_busqueda(cursor):
+    """Crea la tabla cajas_fts y los triggers que la mantienen sincronizada con cajas
+    y con los catálogos. Devuelve False si SQLite no tiene FTS5 con tokenizador trigram."""
+    try:
+        # trigram permite buscar subcadenas (como LIKE '%x%') sin distinguir mayúsculas
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS cajas_fts USING fts5(
+                id_caja, codigo_caja, años, observacion, descripcion, percha, fila, columna,
+                departamento, tipo, bodega, ubicacion,
+                tokenize = 'trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        print("FTS5 no disponible, la búsqueda usará LIKE:", e)
+        return False
+
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS cajas_fts_insert AFTER INSERT ON cajas BEGIN
+            INSERT INTO cajas_fts ({COLUMNAS_FTS}) VALUES ({_valores_fila_fts("NEW")});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS cajas_fts_update AFTER UPDATE ON cajas BEGIN
+            DELETE FROM cajas_fts WHERE rowid = OLD.id;
+            INSERT INTO cajas_fts ({COLUMNAS_FTS}) VALUES ({_valores_fila_fts("NEW")});
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS cajas_fts_delete AFTER DELETE ON cajas BEGIN
+            DELETE FROM cajas_fts WHERE rowid = OLD.id;
+        END
+    """)
+    # Renombrar o eliminar un catálogo actualiza el nombre desnormalizado de sus cajas
+    for tabla, fk, columna in CATALOGOS_BUSQUEDA:
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {tabla}_fts_update AFTER UPDATE OF nombre ON {tabla} BEGIN
+                UPDATE cajas_fts SET {columna} = NEW.nombre
+                WHERE rowid IN (SELECT id FROM cajas WHERE {fk} = NEW.id);
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {tabla}_fts_delete AFTER DELETE ON {tabla} BEGIN
+                UPDATE cajas_fts SET {columna} = NULL
+                WHERE rowid IN (SELECT id FROM cajas WHERE {fk} = OLD.id);
+            END
+        """)
+
+    # Bases creadas antes del índice: poblarlo una sola vez
+    if cursor.execute("SELECT 1 FROM cajas_fts LIMIT 1").fetchone() is None:
+        reconstruir_indice_busqueda(cursor)
+    return True
+
+def reconstruir_indice_busqueda(cursor):
+    """Vuelve a generar cajas_fts completo a partir de la tabla cajas."""
+    cursor.execute("DELETE FROM cajas_fts")
+    cursor.execute(f"INSERT INTO cajas_fts ({COLUMNAS_FTS}) SELECT {_valores_fila_fts('cajas')} FROM cajas")
+
+def construir_consulta_fts(search_term):
+    """Convierte el término de búsqueda en una expresión MATCH de FTS5.
+    Cada palabra se busca como subcadena y deben aparecer todas. Devuelve None cuando
+    el índice no sirve (FTS no disponible o palabras de menos de 3 caracteres)."""
+    if not FTS_DISPONIBLE:
+        return None
+    palabras = search_term.split()
+    if not palabras or any(len(p) < 3 for p in palabras):
+        return None
+    return " ".join('"' + p.replace('"', '""') + '"' for p in palabras)
+
+FTS_DISPONIBLE = create_tables() if not PROCESO_AUXILIAR else False
 
 # ========================================================
 # Modelo de Usuario para Flask-Login
 # ========================================================
-class User(UserMixin):
+class User:
+    """Usuario para Flask-Login. Implementa por sí mismo lo que aporta UserMixin:
+    esa clase no declara __slots__, así que heredarla daría a cada instancia un
+    __dict__ y los slots no ahorrarían memoria en la caché de usuarios."""
+    __slots__ = ("id", "username", "password", "email", "reset_token", "token_expiry")
+
     def __init__(self, id, username, password, email=None, reset_token=None, token_expiry=None):
         self.id = id
         self.username = username
@@ -151,62 +713,90 @@ class User(UserMixin):
         self.reset_token = reset_token
         self.token_expiry = token_expiry
 
+    @property
+    def is_active(self):
+        return True
+
+    @property
+    def is_authenticated(self):
+        return self.is_active
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, User):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __ne__(self, other):
+        igual = self.__eq__(other)
+        if igual is NotImplemented:
+            return NotImplemented
+        return not igual
+
+    def __hash__(self):
+        return hash(self.get_id())
+
+# Búsqueda de un usuario por id, username, email o reset_token (todas indexadas)
+SQL_USUARIO = "SELECT * FROM users WHERE {columna} = ?"
+
+def _usuario_desde_fila(fila):
+    # Bases antiguas pueden no tener email, reset_token ni token_expiry
+    datos = dict(fila)
+    return User(datos["id"], datos["username"], datos["password"], datos.get("email"),
+                datos.get("reset_token"), datos.get("token_expiry"))
+
 def get_user_by_id(user_id):
     conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    user = conn.execute(SQL_USUARIO.format(columna="id"), (user_id,)).fetchone()
     conn.close()
     if not user:
         return None
-    return User(user["id"], user["username"], user["password"], 
-               user["email"] if "email" in user.keys() else None,
-               user["reset_token"] if "reset_token" in user.keys() else None,
-               user["token_expiry"] if "token_expiry" in user.keys() else None)
+    return _usuario_desde_fila(user)
 
 def get_user_by_username(username):
     conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+    user = conn.execute(SQL_USUARIO.format(columna="username"), (username,)).fetchone()
     conn.close()
     if not user:
         return None
-    return User(user["id"], user["username"], user["password"], 
-               user["email"] if "email" in user.keys() else None,
-               user["reset_token"] if "reset_token" in user.keys() else None,
-               user["token_expiry"] if "token_expiry" in user.keys() else None)
+    return _usuario_desde_fila(user)
 
 def update_user_password(user_id, new_password):
     conn = get_db_connection()
-    hashed_password = generate_password_hash(new_password)
+    hashed_password = hashear_clave(new_password)
     conn.execute("UPDATE users SET password = ?, reset_token = NULL, token_expiry = NULL WHERE id = ?", (hashed_password, user_id))
     conn.commit()
     conn.close()
+    invalidar_usuario(user_id)
 
 def update_user_email(user_id, email):
     conn = get_db_connection()
     conn.execute("UPDATE users SET email = ? WHERE id = ?", (email, user_id))
     conn.commit()
     conn.close()
+    invalidar_usuario(user_id)
 
 def get_user_by_email(email):
     conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
+    user = conn.execute(SQL_USUARIO.format(columna="email"), (email,)).fetchone()
     conn.close()
     if not user:
         return None
-    return User(user["id"], user["username"], user["password"], 
-               user["email"] if "email" in user.keys() else None,
-               user["reset_token"] if "reset_token" in user.keys() else None,
-               user["token_expiry"] if "token_expiry" in user.keys() else None)
+    return _usuario_desde_fila(user)
 
 def get_user_by_reset_token(token):
     conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE reset_token = ?", (token,)).fetchone()
+    user = conn.execute(SQL_USUARIO.format(columna="reset_token"), (token,)).fetchone()
     conn.close()
     if not user:
         return None
-    return User(user["id"], user["username"], user["password"], 
-               user["email"] if "email" in user.keys() else None,
-               user["reset_token"] if "reset_token" in user.keys() else None,
-               user["token_expiry"] if "token_expiry" in user.keys() else None)
+    return _usuario_desde_fila(user)
 
 def generate_reset_token(user_id):
     token = secrets.token_urlsafe(32)
@@ -216,11 +806,72 @@ def generate_reset_token(user_id):
                 (token, expiry.isoformat(), user_id))
     conn.commit()
     conn.close()
+    invalidar_usuario(user_id)
     return token
 
+# ========================================================
+# Hash y verificación de contraseñas
+# ========================================================
+# scrypt y pbkdf2 liberan el GIL pero ocupan un núcleo entero; con un pool acotado
+# un grupo de inicios de sesión simultáneos no deja sin CPU al resto de las peticiones.
+_ejecutor_claves = ThreadPoolExecutor(max_workers=app.config['PASSWORD_HILOS'],
+                                      thread_name_prefix="claves")
+
+def hashear_clave(clave):
+    return _ejecutor_claves.submit(generate_password_hash, clave, app.config['PASSWORD_METODO']).result()
+
+def verificar_clave(hash_guardado, clave):
+    return _ejecutor_claves.submit(check_password_hash, hash_guardado, clave).result()
+
+@lru_cache(maxsize=8)
+def _prefijo_metodo(metodo):
+    # werkzeug completa los parámetros omitidos ("scrypt" -> "scrypt:32768:8:1");
+    # el prefijo de un hash de prueba es la forma en que queda guardado
+    return generate_password_hash("", metodo).split("$", 1)[0]
+
+def necesita_rehash(hash_guardado):
+    """True si el hash se generó con un método o costo distinto de PASSWORD_METODO."""
+    return hash_guardado.split("$", 1)[0] != _prefijo_metodo(app.config['PASSWORD_METODO'])
+
+def actualizar_hash_clave(user_id, clave):
+    """Vuelve a guardar la contraseña (ya verificada) con el método configurado."""
+    conn = get_db_connection()
+    conn.execute("UPDATE users SET password = ? WHERE id = ?", (hashear_clave(clave), user_id))
+    conn.commit()
+    conn.close()
+    invalidar_usuario(user_id)
+
+# Usuarios de sesión ya cargados: id (texto) -> (vence, User). Las funciones que
+# modifican users invalidan la entrada; los cambios hechos por otro proceso se
+# ven como máximo USUARIOS_CACHE_SEGUNDOS después.
+_cache_usuarios = OrderedDict()
+_cache_usuarios_lock = threading.Lock()
+
+def invalidar_usuario(user_id):
+    with _cache_usuarios_lock:
+        _cache_usuarios.pop(str(user_id), None)
+
+def get_user_cached(user_id):
+    """Usuario por id desde la caché; solo consulta la base si no está o ya venció."""
+    clave = str(user_id)
+    ahora = time.monotonic()
+    with _cache_usuarios_lock:
+        entrada = _cache_usuarios.get(clave)
+        if entrada is not None and entrada[0] > ahora:
+            _cache_usuarios.move_to_end(clave)
+            return entrada[1]
+    user = get_user_by_id(user_id)
+    if user is not None and app.config['USUARIOS_CACHE_SEGUNDOS'] > 0:
+        with _cache_usuarios_lock:
+            _cache_usuarios[clave] = (ahora + app.config['USUARIOS_CACHE_SEGUNDOS'], user)
+            _cache_usuarios.move_to_end(clave)
+            while len(_cache_usuarios) > app.config['USUARIOS_CACHE_ENTRADAS']:
+                _cache_usuarios.popitem(last=False)
+    return user
+
 @login_manager.user_loader
 def load_user(user_id):
-    return get_user_by_id(user_id)
+    return get_user_cached(user_id)
 
 # ========================================================
 # Formularios con Flask-WTF
@@ -281,7 +932,7 @@ class PrestamoForm(FlaskForm):
 
 # Formulario para cargar archivo Excel
 class ExcelUploadForm(FlaskForm):
-    archivo = FileField('Archivo Excel', validators=[DataRequired()])
+    archivo = FileField('Archivo Excel o CSV', validators=[DataRequired()])
     submit = SubmitField('Cargar Archivo')
     
     def __init__(self, *args, **kwargs):
@@ -291,6 +942,7 @@ class ExcelUploadForm(FlaskForm):
 # Formularios para los nuevos catálogos
 class DepartamentoForm(FlaskForm):
     nombre = StringField("Nombre del Departamento", validators=[DataRequired()])
+    cover_template = SelectField("Plantilla de portada", choices=[])
     submit = SubmitField("Guardar Departamento")
 
 class TipoForm(FlaskForm):
@@ -310,7 +962,7 @@ class UbicacionForm(FlaskForm):
 # Funciones para manejo de catálogos y cajas
 # ========================================================
 
-def procesar_excel_cajas(archivo_path):
+def procesar_excel_cajas(archivo_path, progreso=None):
     """Procesa un archivo Excel para importar cajas a la base de datos.
     El archivo debe tener las siguientes columnas:
     - id_caja (opcional, si no se proporciona se generará automáticamente)
@@ -325,134 +977,499 @@ def procesar_excel_cajas(archivo_path):
     - Percha
     - Fila
     - Columna
+    También acepta CSV con las mismas columnas. El archivo se lee por streaming en
+    lotes de IMPORTACION_TAMANO_LOTE filas, de modo que la memoria no crece con su
+    tamaño. Si se indica progreso, se llama tras cada lote como
+    progreso(leidas, insertadas, rechazadas, total) y la importación se detiene
+    cuando devuelve False.
+    Devuelve (exito, mensaje, cancelado); cancelado solo es True si quedaron
+    lotes sin importar, así que una cancelación tras el último lote no cuenta.
     """
+    lotes = None
     try:
-        # Leer el archivo Excel
-        df = pd.read_excel(archivo_path)
+        # Leer el archivo por lotes
+        tamano_lote = app.config['IMPORTACION_TAMANO_LOTE']
+        columnas, total, maximo_id, lotes = leer_archivo_cajas(archivo_path, tamano_lote)
         
         # Verificar columnas requeridas
         columnas_requeridas = ['codigo_caja', 'Departamento', 'Años', 'Tipo', 'Bodega', 'Ubicacion', 'Percha', 'Fila', 'Columna']
-        columnas_faltantes = [col for col in columnas_requeridas if col not in df.columns]
+        columnas_faltantes = [col for col in columnas_requeridas if col not in columnas]
         
         if columnas_faltantes:
-            return False, f"Faltan columnas requeridas: {', '.join(columnas_faltantes)}"
-        
-        # Obtener mapeo de nombres a IDs
-        conn = get_db_connection()
-        departamentos = {d['nombre']: d['id'] for d in conn.execute("SELECT id, nombre FROM departamentos").fetchall()}
-        tipos = {t['nombre']: t['id'] for t in conn.execute("SELECT id, nombre FROM tipos").fetchall()}
-        bodegas = {b['nombre']: b['id'] for b in conn.execute("SELECT id, nombre FROM bodegas").fetchall()}
-        ubicaciones = {u['nombre']: u['id'] for u in conn.execute("SELECT id, nombre FROM ubicaciones").fetchall()}
+            return False, f"Faltan columnas requeridas: {', '.join(columnas_faltantes)}", False
         
-        # Verificar IDs de cajas existentes
-        cajas_existentes = {c['id_caja'] for c in conn.execute("SELECT id_caja FROM cajas").fetchall()}
-        conn.close()
-        
-        # Procesar cada fila
-        cajas_agregadas = 0
+        insertadas = 0
+        leidas = 0
+        rechazadas = 0
+        # Solo se conservan los primeros errores para el mensaje; el resto se cuenta
         errores = []
-        
-        for i, row in df.iterrows():
-            try:
-                # Verificar si existen los catálogos
-                if row['Departamento'] not in departamentos:
-                    errores.append(f"Fila {i+2}: Departamento '{row['Departamento']}' no existe")
-                    continue
-                    
-                if row['Tipo'] not in tipos:
-                    errores.append(f"Fila {i+2}: Tipo '{row['Tipo']}' no existe")
-                    continue
-                    
-                if row['Bodega'] not in bodegas:
-                    errores.append(f"Fila {i+2}: Bodega '{row['Bodega']}' no existe")
-                    continue
-                    
-                if row['Ubicacion'] not in ubicaciones:
-                    errores.append(f"Fila {i+2}: Ubicación '{row['Ubicacion']}' no existe")
-                    continue
-                
-                # Obtener valores
-                codigo_caja = str(row.get('codigo_caja', '')) if not pd.isna(row.get('codigo_caja', '')) else ''
-                departamento_id = departamentos[row['Departamento']]
-                años = str(row['Años'])
-                tipo_id = tipos[row['Tipo']]
-                observacion = str(row.get('Observacion', '')) if not pd.isna(row.get('Observacion', '')) else ''
-                descripcion = str(row.get('Descripcion', '')) if not pd.isna(row.get('Descripcion', '')) else ''
-                bodega_id = bodegas[row['Bodega']]
-                ubicacion_id = ubicaciones[row['Ubicacion']]
-                percha = str(row['Percha'])
-                fila = str(row['Fila'])
-                columna = str(row['Columna'])
-                
-                # Verificar si se proporciona id_caja
-                if 'id_caja' in df.columns and not pd.isna(row['id_caja']):
-                    # Asegurar que el id_caja tenga 5 dígitos, rellenando con ceros a la izquierda
-                    id_caja = str(int(row['id_caja'])).zfill(5)
-                    
-                    # Verificar si ya existe
-                    if id_caja in cajas_existentes:
-                        errores.append(f"Fila {i+2}: El ID de caja '{id_caja}' ya existe en la base de datos")
-                        continue
-                    
-                    # Agregar caja con id_caja específico
-                    conn = get_db_connection()
-                    cursor = conn.cursor()
-                    qr_filename = os.path.join(QR_DIR, f"{id_caja}.png")
-                    generate_qr_code(id_caja, qr_filename)
-                    cursor.execute(
-                        "INSERT INTO cajas (id_caja, codigo_caja, departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, qr_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (id_caja, codigo_caja, departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, qr_filename)
-                    )
-                    conn.commit()
-                    conn.close()
-                    
-                    # Actualizar conjunto de IDs existentes
-                    cajas_existentes.add(id_caja)
-                else:
-                    # Usar la función existente para generar id_caja automáticamente
-                    add_caja(departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, codigo_caja)
-                
-                cajas_agregadas += 1
-                
-            except Exception as e:
-                errores.append(f"Error en fila {i+2}: {str(e)}")
+        cancelado = False
+        detener = progreso is not None and progreso(0, 0, 0, total) is False
+        for lote in lotes:
+            # Solo se da por cancelada si aún quedaba un lote por importar
+            if detener:
+                cancelado = True
+                break
+            ids_insertados, errores_lote = importar_cajas_dataframe(lote, minimo_automatico=maximo_id)
+            
+            # Generar los códigos QR después de confirmar la transacción
+            if not app.config['QR_EN_MEMORIA']:
+                generar_qr_cajas(get_cajas_para_qr(ids_caja=ids_insertados))
+            insertadas += len(ids_insertados)
+            rechazadas += len(errores_lote)
+            if sum(len(e) for e in errores) < 5:
+                errores.append(errores_lote.head(5))
+            leidas += len(lote)
+            if progreso is not None and progreso(leidas, insertadas, rechazadas, max(total or 0, leidas)) is False:
+                detener = True
+        errores = _reporte_errores(errores)
         
         # Preparar mensaje de resultado
-        mensaje = f"Se importaron {cajas_agregadas} cajas correctamente."
-        if errores:
-            mensaje += f" Hubo {len(errores)} errores: {'; '.join(errores[:5])}"
-            if len(errores) > 5:
-                mensaje += f" y {len(errores) - 5} más."
+        mensaje = f"Se importaron {insertadas} cajas correctamente."
+        if cancelado:
+            mensaje = f"Importación cancelada. {mensaje}"
+        if rechazadas:
+            primeros = [f"Fila {fila}: {error}" for fila, error in errores.head(5).itertuples(index=False, name=None)]
+            mensaje += f" Hubo {rechazadas} errores: {'; '.join(primeros)}"
+            if rechazadas > 5:
+                mensaje += f" y {rechazadas - 5} más."
         
-        return True, mensaje
+        return True, mensaje, cancelado
         
     except Exception as e:
-        return False, f"Error al procesar el archivo: {str(e)}"
+        return False, f"Error al procesar el archivo: {str(e)}", False
+    finally:
+        if lotes is not None:
+            lotes.close()
+
+# Extensiones aceptadas por la importación de cajas
+EXTENSIONES_IMPORTACION = ('.xlsx', '.xlsm', '.xls', '.csv')
+
+def leer_archivo_cajas(archivo_path, tamano_lote):
+    """Abre un archivo de cajas (Excel o CSV) para leerlo por lotes.
+    Devuelve (columnas, total_estimado, maximo_id, lotes), donde lotes es un
+    generador de DataFrames de hasta tamano_lote filas cuyo índice es la posición de
+    la fila de datos (0 = primera fila después del encabezado). total_estimado puede
+    ser None. maximo_id es el mayor id_caja entero de todo el archivo (0 si no hay):
+    se obtiene antes del primer lote para que los números automáticos de un lote no
+    choquen con ids explícitos de lotes posteriores."""
+    extension = os.path.splitext(archivo_path)[1].lower()
+    if extension == '.csv':
+        return _leer_csv_cajas(archivo_path, tamano_lote)
+    if extension == '.xls':
+        # openpyxl no lee el formato antiguo; se carga completo con pandas
+        df = pd.read_excel(archivo_path)
+        lotes = (df.iloc[inicio:inicio + tamano_lote] for inicio in range(0, len(df), tamano_lote))
+        maximo_id = _maximo_id_caja([df['id_caja']] if 'id_caja' in df.columns else [])
+        return list(df.columns), len(df), maximo_id, lotes
+    return _leer_xlsx_cajas(archivo_path, tamano_lote)
+
+def _maximo_id_caja(bloques):
+    """Mayor id_caja entero en una secuencia de bloques de valores (0 si no hay).
+    Los valores no numéricos o con decimales se ignoran: la importación los rechaza."""
+    maximo = 0
+    for bloque in bloques:
+        numeros = pd.to_numeric(pd.Series(bloque, dtype=object), errors='coerce')
+        numeros = numeros[numeros.notna() & (numeros % 1 == 0)]
+        if len(numeros):
+            maximo = max(maximo, int(numeros.max()))
+    return maximo
+
+def _leer_xlsx_cajas(archivo_path, tamano_lote):
+    # read_only recorre el XML de la hoja sin construir el libro en memoria
+    libro = openpyxl.load_workbook(archivo_path, read_only=True, data_only=True)
+    hoja = libro.active
+    filas = hoja.iter_rows(values_only=True)
+    encabezado = next(filas, None)
+    if encabezado is None:
+        libro.close()
+        return [], 0, 0, iter(())
+    columnas = [str(c) if c is not None else f"Unnamed: {i}" for i, c in enumerate(encabezado)]
+    total = hoja.max_row - 1 if hoja.max_row else None
+    maximo_id = 0
+    if 'id_caja' in columnas:
+        # Pasada previa solo por la columna id_caja, en bloques para no cargarla entera
+        columna = columnas.index('id_caja') + 1
+        valores = (fila[0] for fila in hoja.iter_rows(min_row=2, min_col=columna, max_col=columna,
+                                                      values_only=True))
+        maximo_id = _maximo_id_caja(iter(lambda: list(islice(valores, tamano_lote)), []))
+
+    def lotes():
+        try:
+            lote, indices = [], []
+            for posicion, fila in enumerate(filas):
+                # Las filas completamente vacías se ignoran, como en pd.read_excel
+                if all(valor is None for valor in fila):
+                    continue
+                lote.append(fila[:len(columnas)])
+                indices.append(posicion)
+                if len(lote) == tamano_lote:
+                    yield pd.DataFrame(lote, columns=columnas, index=indices)
+                    lote, indices = [], []
+            if lote:
+                yield pd.DataFrame(lote, columns=columnas, index=indices)
+        finally:
+            libro.close()
+
+    return columnas, total, maximo_id, lotes()
+
+# Codificaciones probadas en orden: UTF-8 (con o sin BOM) y la de Excel en Windows.
+# latin-1 acepta cualquier byte, así que siempre sirve como último recurso.
+CODIFICACIONES_CSV = ('utf-8-sig', 'cp1252', 'latin-1')
+
+def _analizar_csv(archivo_path):
+    """Cuenta las líneas del CSV y detecta su codificación en una sola pasada.
+    Se lee por bloques de bytes (costo lineal pero memoria constante) y cada bloque
+    pasa por decodificadores incrementales que se descartan al primer error, de modo
+    que un acento en la última fila no aborta la importación a mitad de camino.
+    Devuelve (codificacion, total_lineas)."""
+    decodificadores = {nombre: codecs.getincrementaldecoder(nombre)() for nombre in CODIFICACIONES_CSV}
+    lineas = 0
+    with open(archivo_path, 'rb') as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b''):
+            lineas += bloque.count(b'\n')
+            for nombre, decodificador in list(decodificadores.items()):
+                try:
+                    decodificador.decode(bloque)
+                except UnicodeDecodeError:
+                    del decodificadores[nombre]
+    for nombre, decodificador in decodificadores.items():
+        try:
+            decodificador.decode(b'', final=True)
+            return nombre, lineas
+        except UnicodeDecodeError:
+            continue
+    return CODIFICACIONES_CSV[-1], lineas
+
+def _leer_csv_cajas(archivo_path, tamano_lote):
+    codificacion, total = _analizar_csv(archivo_path)
+    total -= 1
+    # sep=None detecta "," o ";" (habitual en Excel en español)
+    lector = pd.read_csv(archivo_path, chunksize=tamano_lote, sep=None, engine='python', encoding=codificacion)
+    primero = next(lector, None)
+    if primero is None:
+        lector.close()
+        return [], 0, 0, iter(())
+    maximo_id = 0
+    if 'id_caja' in primero.columns:
+        # Pasada previa solo por la columna id_caja, por lotes como la importación
+        with pd.read_csv(archivo_path, chunksize=tamano_lote, sep=None, engine='python',
+                         encoding=codificacion, usecols=['id_caja']) as ids:
+            maximo_id = _maximo_id_caja(lote['id_caja'] for lote in ids)
+
+    def lotes():
+        try:
+            yield primero
+            yield from lector
+        finally:
+            lector.close()
+
+    return list(primero.columns), max(total, 0), maximo_id, lotes()
+
+def _texto_opcional(df, columna):
+    """Columna como texto, con '' para celdas vacías o columnas ausentes."""
+    if columna not in df.columns:
+        return pd.Series('', index=df.index)
+    return df[columna].where(df[columna].notna(), '').astype(str)
+
+def importar_cajas_dataframe(df, fila_inicial=2, minimo_automatico=None):
+    """Inserta en bloque las cajas de un DataFrame con las columnas de procesar_excel_cajas.
+    La validación es vectorizada: los nombres de catálogo se traducen con map y los
+    id_caja se comparan con isin, sin recorrer fila por fila. Los id_caja faltantes se
+    asignan como un rango consecutivo y todas las filas válidas se insertan con un solo
+    executemany en una transacción.
+    Los números automáticos empiezan por encima de minimo_automatico; cuando el
+    DataFrame es un lote de un archivo más grande debe ser el mayor id_caja de todo
+    el archivo, o un lote podría tomar un número que otro trae de forma explícita.
+    Si es None se usa el mayor id_caja del propio DataFrame.
+    Devuelve (ids_insertados, errores), donde errores es un DataFrame con las columnas
+    fila (número de fila en la hoja) y error, ordenado por fila."""
+    filas = pd.Series(df.index, index=df.index) + fila_inicial
+    validas = pd.Series(True, index=df.index)
+    errores = []
+
+    def rechazar(mascara, mensajes):
+        nonlocal validas
+        mascara = mascara & validas
+        errores.append(pd.DataFrame({'fila': filas[mascara], 'error': mensajes[mascara]}))
+        validas = validas & ~mascara
+
+    conn = get_db_connection()
+    try:
+        # Traducir nombres de catálogo a ids; la primera columna inválida de cada fila es la que se informa
+        catalogos = [('Departamento', 'departamentos', 'Departamento'), ('Tipo', 'tipos', 'Tipo'),
+                     ('Bodega', 'bodegas', 'Bodega'), ('Ubicacion', 'ubicaciones', 'Ubicación')]
+        ids_catalogo = {}
+        for columna, tabla, etiqueta in catalogos:
+            ids_catalogo[columna] = df[columna].map(get_catalogo(tabla).por_nombre)
+            rechazar(ids_catalogo[columna].isna(),
+                     etiqueta + " '" + df[columna].astype(str) + "' no existe")
+
+        # La comprobación de id_caja existentes y la inserción van en la misma
+        # transacción de escritura, para que un add_caja concurrente no se cuele entre ambas
+        conn.execute("BEGIN IMMEDIATE")
+
+        # id_caja proporcionados en el archivo
+        if 'id_caja' in df.columns:
+            con_id = df['id_caja'].notna()
+            numeros = pd.to_numeric(df['id_caja'], errors='coerce')
+            rechazar(con_id & numeros.isna(), "El ID de caja '" + df['id_caja'].astype(str) + "' no es numérico")
+            rechazar(con_id & numeros.notna() & (numeros % 1 != 0),
+                     "El ID de caja '" + df['id_caja'].astype(str) + "' no es un número entero")
+            numeros = numeros.where(validas & con_id).astype('Int64')
+            texto_ids = numeros.astype(str).str.zfill(5)
+            # Solo se consultan los números presentes en el archivo (búsqueda por índice)
+            candidatos = json.dumps(numeros.dropna().astype(int).tolist())
+            existentes = pd.read_sql_query(
+                "SELECT numero_caja FROM cajas WHERE numero_caja IN (SELECT value FROM json_each(?))",
+                conn, params=(candidatos,))['numero_caja']
+            rechazar(numeros.isin(existentes).fillna(False),
+                     "El ID de caja '" + texto_ids + "' ya existe en la base de datos")
+            rechazar(numeros.where(validas).duplicated(keep='first') & numeros.notna(),
+                     "El ID de caja '" + texto_ids + "' está repetido en el archivo")
+            con_id = con_id & validas
+        else:
+            con_id = pd.Series(False, index=df.index)
+            numeros = pd.Series(pd.NA, index=df.index, dtype='Int64')
+
+        if not validas.any():
+            conn.rollback()
+            return [], _reporte_errores(errores)
+
+        # Reservar el rango de id_caja automáticos e insertar en la misma transacción
+        if minimo_automatico is None:
+            minimo_automatico = numeros[con_id].max() if con_id.any() else 0
+        sin_id = validas & ~con_id
+        numeros = numeros.copy()
+        if sin_id.any():
+            # Un solo UPDATE reserva el bloque completo de números automáticos
+            inicio = reservar_numeros_caja(conn, int(sin_id.sum()), minimo=int(minimo_automatico))
+            numeros[sin_id] = range(inicio, inicio + int(sin_id.sum()))
+
+        v = validas
+        id_caja = numeros[v].astype(str).str.zfill(5)
+        registros = pd.DataFrame({
+            'id_caja': id_caja,
+            'numero_caja': numeros[v].astype('int64'),
+            'codigo_caja': _texto_opcional(df, 'codigo_caja')[v],
+            'departamento_id': ids_catalogo['Departamento'][v].astype('int64'),
+            'años': df.loc[v, 'Años'].astype(str),
+            'tipo_id': ids_catalogo['Tipo'][v].astype('int64'),
+            'observacion': _texto_opcional(df, 'Observacion')[v],
+            'descripcion': _texto_opcional(df, 'Descripcion')[v],
+            'bodega_id': ids_catalogo['Bodega'][v].astype('int64'),
+            'ubicacion_id': ids_catalogo['Ubicacion'][v].astype('int64'),
+            'percha': df.loc[v, 'Percha'].astype(str),
+            'fila': df.loc[v, 'Fila'].astype(str),
+            'columna': df.loc[v, 'Columna'].astype(str),
+            'qr_path': os.path.join(QR_DIR, '') + id_caja + '.png',
+        })
+        conn.executemany(
+            "INSERT INTO cajas (id_caja, numero_caja, codigo_caja, departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, qr_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            registros.astype(object).itertuples(index=False, name=None)
+        )
+        conn.commit()
+        return registros['id_caja'].tolist(), _reporte_errores(errores)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def _reporte_errores(errores):
+    """Une los DataFrames de errores de varios lotes en uno solo ordenado por fila."""
+    errores = [e for e in errores if len(e)]
+    reporte = pd.concat(errores, ignore_index=True) if errores else pd.DataFrame(columns=['fila', 'error'])
+    return reporte.sort_values('fila', kind='stable').reset_index(drop=True)
+
 def generate_qr_code(data, filename):
-    img = qrcode.make(data)
-    img.save(filename)
+    generar_qr(data, filename)
+
+def generar_qr_lote(tareas, forzar=False):
+    """Genera los códigos QR de una lista de (datos, archivo) en el pool de procesos."""
+    resultado = generar_lote(tareas, procesos=app.config['QR_PROCESOS'], forzar=forzar)
+    if resultado['generados']:
+        print(f"QR generados: {resultado['generados']} (omitidos {resultado['omitidos']}) "
+              f"en {resultado['segundos']:.2f}s, {resultado['qr_por_segundo']:.0f} QR/s")
+    return resultado
 
-def get_next_id_caja():
+# ========================================================
+# Caché de códigos QR direccionada por contenido
+# ========================================================
+# Cada PNG se guarda como static/qr_codes/<hash>.png, donde el hash cubre el
+# contenido y los parámetros de codificación. qr_manifiesto recuerda a qué hash
+# apunta cada caja, de modo que saber qué QR faltan es una sola consulta.
+
+def datos_qr_caja(caja):
+    """Contenido del QR impreso en etiquetas y portadas (el mismo en toda la aplicación)."""
+    return f"ID: {caja['id_caja']}\nCódigo: {caja['codigo_caja']}\nDepartamento: {caja['departamento']}\nTipo: {caja['tipo']}"
+
+def archivo_qr(hash_contenido):
+    """Ruta del QR relativa a static/, para usar con url_for('static', ...)."""
+    return f"qr_codes/{hash_contenido}.png"
+
+def get_manifiesto_qr(conn, caja_ids):
+    """Hash registrado para cada caja, en una sola consulta."""
+    filas = conn.execute(
+        "SELECT caja_id, hash FROM qr_manifiesto WHERE caja_id IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(caja_ids)),)
+    ).fetchall()
+    return {fila['caja_id']: fila['hash'] for fila in filas}
+
+def generar_qr_cajas(cajas, forzar=False):
+    """
+    Genera los QR de las cajas indicadas y actualiza el manifiesto.
+
+    Las cajas deben traer id, id_caja, codigo_caja, departamento y tipo. Varias
+    cajas con el mismo contenido comparten un único archivo.
+    """
+    hashes = {}
+    tareas = {}
+    for caja in cajas:
+        datos = datos_qr_caja(caja)
+        hash_contenido = hash_qr(datos)
+        hashes[caja['id']] = hash_contenido
+        tareas[hash_contenido] = (datos, os.path.join("static", archivo_qr(hash_contenido)))
+    resultado = generar_qr_lote(tareas.values(), forzar=forzar)
+    if hashes:
+        ahora = datetime.datetime.now().isoformat(timespec='seconds')
+        conn = get_db_connection()
+        conn.executemany(
+            "INSERT INTO qr_manifiesto (caja_id, hash, actualizado) VALUES (?, ?, ?) "
+            "ON CONFLICT(caja_id) DO UPDATE SET hash = excluded.hash, actualizado = excluded.actualizado",
+            [(caja_id, hash_contenido, ahora) for caja_id, hash_contenido in hashes.items()]
+        )
+        conn.commit()
+        conn.close()
+    return resultado
+
+# Un único hilo encola los lotes pedidos desde las rutas; cada lote se reparte
+# a su vez entre los procesos de qr_lotes.
+_ejecutor_qr = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qr")
+
+def programar_qr(cajas):
+    """Genera en segundo plano los QR de las cajas indicadas, sin bloquear la petición."""
+    cajas = [dict(caja) for caja in cajas]
+    if cajas:
+        return _ejecutor_qr.submit(generar_qr_cajas, cajas)
+    return None
+
+def preparar_qr_cajas(cajas):
+    """
+    Devuelve {caja.id: URL del QR} para una página de etiquetas o portadas.
+
+    Con QR_EN_MEMORIA la URL apunta a /qr/<id_caja>.png con el hash como versión,
+    así el navegador la guarda como inmutable. Si no, compara el hash esperado de
+    cada caja con el manifiesto en una sola consulta y programa en segundo plano
+    solo las que están obsoletas o no existen.
+    """
+    esperados = {caja['id']: hash_qr(datos_qr_caja(caja)) for caja in cajas}
+    if app.config['QR_EN_MEMORIA']:
+        return {caja['id']: url_for('qr_imagen', id_caja=caja['id_caja'], formato='png', v=esperados[caja['id']])
+                for caja in cajas}
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT MAX(id_caja) FROM cajas")
-    max_id = cursor.fetchone()[0]
+    manifiesto = get_manifiesto_qr(conn, esperados)
     conn.close()
-    next_id = 1 if max_id is None else int(max_id) + 1
-    return str(next_id).zfill(5)
+    programar_qr([caja for caja in cajas if manifiesto.get(caja['id']) != esperados[caja['id']]])
+    return {caja_id: url_for('static', filename=archivo_qr(hash_contenido))
+            for caja_id, hash_contenido in esperados.items()}
+
+# Bytes ya codificados, por (hash, formato); el hash cubre contenido y parámetros
+_cache_qr = OrderedDict()
+_cache_qr_lock = threading.Lock()
+
+def get_qr_bytes(datos, hash_contenido, formato):
+    clave = (hash_contenido, formato)
+    with _cache_qr_lock:
+        contenido = _cache_qr.get(clave)
+        if contenido is not None:
+            _cache_qr.move_to_end(clave)
+            return contenido
+    contenido = codificar_qr(datos, formato)
+    with _cache_qr_lock:
+        _cache_qr[clave] = contenido
+        _cache_qr.move_to_end(clave)
+        while len(_cache_qr) > app.config['QR_CACHE_ENTRADAS']:
+            _cache_qr.popitem(last=False)
+    return contenido
+
+# Cajas con departamento y tipo para generar o imprimir sus QR
+SQL_CAJAS_QR = """
+    SELECT cajas.*, departamentos.nombre AS departamento, tipos.nombre AS tipo
+    FROM cajas
+    LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id
+    LEFT JOIN tipos ON cajas.tipo_id = tipos.id
+    WHERE {filtro}
+    ORDER BY cajas.numero_caja
+"""
+
+def get_cajas_para_qr(desde=None, hasta=None, departamento_id=None, ids_caja=None):
+    """Cajas (con departamento y tipo) de un rango de números, un departamento o una lista de id_caja."""
+    condiciones, params = [], []
+    if ids_caja is not None:
+        condiciones.append("cajas.id_caja IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(ids_caja)))
+    if desde is not None:
+        condiciones.append("cajas.numero_caja >= ?")
+        params.append(desde)
+    if hasta is not None:
+        condiciones.append("cajas.numero_caja <= ?")
+        params.append(hasta)
+    if departamento_id is not None:
+        condiciones.append("cajas.departamento_id = ?")
+        params.append(departamento_id)
+    conn = get_db_connection()
+    cajas = conn.execute(SQL_CAJAS_QR.format(filtro=" AND ".join(condiciones) or "1"), params).fetchall()
+    conn.close()
+    return cajas
+
+# Incrementa la secuencia y devuelve el último número del bloque reservado. El valor
+# nunca queda por debajo del mayor numero_caja (cajas con ID explícito, scripts
+# externos) ni del mínimo pedido por quien llama.
+SQL_RESERVAR_NUMEROS = """
+    UPDATE secuencias
+    SET valor = MAX(valor, (SELECT COALESCE(MAX(numero_caja), 0) FROM cajas), ?) + ?
+    WHERE nombre = 'numero_caja'
+    RETURNING valor
+"""
+
+def reservar_numeros_caja(conn, cantidad=1, minimo=0):
+    """
+    Reserva `cantidad` números de caja consecutivos y devuelve el primero.
+
+    Si la conexión no tiene una transacción abierta se usa una propia con
+    BEGIN IMMEDIATE; si ya la tiene (p. ej. la importación), la reserva queda dentro
+    de ella y se confirma o deshace junto con los INSERT.
+    """
+    propia = not conn.in_transaction
+    if propia:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        ultimo = conn.execute(SQL_RESERVAR_NUMEROS, (minimo, cantidad)).fetchone()[0]
+        if propia:
+            conn.commit()
+    except sqlite3.Error:
+        if propia:
+            conn.rollback()
+        raise
+    return ultimo - cantidad + 1
 
 def add_caja(departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, codigo_caja=''):
     conn = get_db_connection()
     cursor = conn.cursor()
-    id_caja = get_next_id_caja()
+    # El número se reserva e inserta en la misma transacción de escritura
+    conn.execute("BEGIN IMMEDIATE")
+    numero = reservar_numeros_caja(conn)
+    id_caja = str(numero).zfill(5)
     qr_filename = os.path.join(QR_DIR, f"{id_caja}.png")
-    generate_qr_code(id_caja, qr_filename)
     cursor.execute(
-       "INSERT INTO cajas (id_caja, codigo_caja, departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, qr_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-       (id_caja, codigo_caja, departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, qr_filename)
+       "INSERT INTO cajas (id_caja, numero_caja, codigo_caja, departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, qr_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+       (id_caja, numero, codigo_caja, departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, qr_filename)
     )
     conn.commit()
     conn.close()
+    if not app.config['QR_EN_MEMORIA']:
+        programar_qr(get_cajas_para_qr(ids_caja=[id_caja]))
     return id_caja
 
 def update_caja(caja_id, departamento_id, años, tipo_id, observacion, descripcion, bodega_id, ubicacion_id, percha, fila, columna, codigo_caja):
@@ -465,158 +1482,392 @@ def update_caja(caja_id, departamento_id, años, tipo_id, observacion, descripci
     conn.commit()
     conn.close()
 
+SQL_BORRAR_PRESTAMOS_CAJA = "DELETE FROM prestamos WHERE caja_id = ?"
+
 def delete_caja(caja_id):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM prestamos WHERE caja_id = ?", (caja_id,))
+    cursor.execute(SQL_BORRAR_PRESTAMOS_CAJA, (caja_id,))
     cursor.execute("DELETE FROM cajas WHERE id = ?", (caja_id,))
     conn.commit()
     conn.close()
 
+SQL_CAJA_POR_ID = """
+    SELECT cajas.*, departamentos.nombre AS departamento, tipos.nombre AS tipo,
+           bodegas.nombre AS bodega, ubicaciones.nombre AS ubicacion
+    FROM cajas
+    LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id
+    LEFT JOIN tipos ON cajas.tipo_id = tipos.id
+    LEFT JOIN bodegas ON cajas.bodega_id = bodegas.id
+    LEFT JOIN ubicaciones ON cajas.ubicacion_id = ubicaciones.id
+    WHERE cajas.id = ?
+"""
+
 def get_caja_by_id(caja_id):
     conn = get_db_connection()
-    caja = conn.execute("""
-        SELECT cajas.*, departamentos.nombre AS departamento, tipos.nombre AS tipo, 
-               bodegas.nombre AS bodega, ubicaciones.nombre AS ubicacion
-        FROM cajas
-        LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id
-        LEFT JOIN tipos ON cajas.tipo_id = tipos.id
-        LEFT JOIN bodegas ON cajas.bodega_id = bodegas.id
-        LEFT JOIN ubicaciones ON cajas.ubicacion_id = ubicaciones.id
-        WHERE cajas.id = ?
-    """, (caja_id,)).fetchone()
+    caja = conn.execute(SQL_CAJA_POR_ID, (caja_id,)).fetchone()
     conn.close()
     return caja
 
-def search_cajas(search_term, page=1, per_page=50):
+# Listado de cajas con los nombres de sus catálogos. Lo usan el listado completo,
+# la búsqueda con LIKE y la paginación por cursor; cada una completa filtro y orden.
+SQL_LISTADO_CAJAS = """
+    SELECT c.*,
+    d.nombre as departamento, t.nombre as tipo,
+    b.nombre as bodega, u.nombre as ubicacion
+    FROM cajas c
+    LEFT JOIN departamentos d ON c.departamento_id = d.id
+    LEFT JOIN tipos t ON c.tipo_id = t.id
+    LEFT JOIN bodegas b ON c.bodega_id = b.id
+    LEFT JOIN ubicaciones u ON c.ubicacion_id = u.id
+    WHERE {filtro}
+    ORDER BY {orden}
+    LIMIT ? OFFSET ?
+"""
+
+# Búsqueda con el índice FTS; el orden es por relevancia (bm25) o por número de caja
+SQL_BUSQUEDA_FTS = """
+    SELECT c.*,
+    d.nombre as departamento, t.nombre as tipo,
+    b.nombre as bodega, u.nombre as ubicacion
+    FROM cajas_fts
+    JOIN cajas c ON c.id = cajas_fts.rowid
+    LEFT JOIN departamentos d ON c.departamento_id = d.id
+    LEFT JOIN tipos t ON c.tipo_id = t.id
+    LEFT JOIN bodegas b ON c.bodega_id = b.id
+    LEFT JOIN ubicaciones u ON c.ubicacion_id = u.id
+    WHERE cajas_fts MATCH ?
+    ORDER BY {orden}
+    LIMIT ? OFFSET ?
+"""
+
+def search_cajas(search_term, page=1, per_page=50, por_relevancia=True):
+    consulta_fts = construir_consulta_fts(search_term)
+    if consulta_fts is None:
+        return search_cajas_like(search_term, page, per_page)
+    orden = "cajas_fts.rank, c.id" if por_relevancia else "c.numero_caja, c.id"
+
+    total, _ = count_cajas(search_term)
     conn = get_db_connection()
+
+    # Calcular el offset para la paginación
+    offset = (page - 1) * per_page
+
+    # Resultados ordenados por relevancia (bm25) o por número de caja
+    cajas = conn.execute(SQL_BUSQUEDA_FTS.format(orden=orden), (consulta_fts, per_page, offset)).fetchall()
+    conn.close()
+    return cajas, total
+
+def _filtro_like_cajas(search_term):
+    """Condición WHERE con LIKE sobre todas las columnas visibles de la caja
+    (alias c y catálogos d, t, b, u) y sus parámetros."""
+    columnas = ["c.id_caja", "c.codigo_caja", "d.nombre", "c.años", "t.nombre", "c.observacion",
+                "c.descripcion", "b.nombre", "u.nombre", "c.percha", "c.fila", "c.columna"]
     search_pattern = f'%{search_term}%'
+    return "(" + " OR ".join(f"{col} LIKE ?" for col in columnas) + ")", [search_pattern] * len(columnas)
+
+def _filtro_busqueda_cajas(search_term):
+    """Como _filtro_like_cajas, pero usando el índice FTS cuando el término lo permite."""
+    if not search_term:
+        return "1", []
+    consulta_fts = construir_consulta_fts(search_term)
+    if consulta_fts is not None:
+        return "c.id IN (SELECT rowid FROM cajas_fts WHERE cajas_fts MATCH ?)", [consulta_fts]
+    return _filtro_like_cajas(search_term)
+
+def search_cajas_like(search_term, page=1, per_page=50):
+    """Búsqueda con LIKE sobre todas las columnas; se usa cuando el término no puede
+    resolverse con el índice FTS."""
+    filtro, params = _filtro_like_cajas(search_term)
     
     # Obtener el total de resultados para la paginación
-    total = conn.execute("""
-        SELECT COUNT(*) 
-        FROM cajas c
-        LEFT JOIN departamentos d ON c.departamento_id = d.id
-        LEFT JOIN tipos t ON c.tipo_id = t.id
-        LEFT JOIN bodegas b ON c.bodega_id = b.id
-        LEFT JOIN ubicaciones u ON c.ubicacion_id = u.id
-        WHERE c.id_caja LIKE ? 
-        OR c.codigo_caja LIKE ? 
-        OR d.nombre LIKE ? 
-        OR c.años LIKE ? 
-        OR t.nombre LIKE ? 
-        OR c.observacion LIKE ? 
-        OR c.descripcion LIKE ? 
-        OR b.nombre LIKE ? 
-        OR u.nombre LIKE ? 
-        OR c.percha LIKE ? 
-        OR c.fila LIKE ? 
-        OR c.columna LIKE ?
-    """, (search_pattern, search_pattern, search_pattern, 
-          search_pattern, search_pattern, search_pattern,
-          search_pattern, search_pattern, search_pattern,
-          search_pattern, search_pattern, search_pattern)).fetchone()[0]
+    total, _ = count_cajas(search_term)
+    conn = get_db_connection()
     
     # Calcular el offset para la paginación
     offset = (page - 1) * per_page
     
     # Obtener los resultados para la página actual
-    cajas = conn.execute("""
-        SELECT c.*, d.nombre as departamento, t.nombre as tipo, 
-        b.nombre as bodega, u.nombre as ubicacion
+    cajas = conn.execute(SQL_LISTADO_CAJAS.format(filtro=filtro, orden="c.numero_caja, c.id"),
+                         params + [per_page, offset]).fetchall()
+    conn.close()
+    return cajas, total
+
+# Columnas de la exportación: (expresión SQL, encabezado en el Excel)
+COLUMNAS_EXPORTACION = [
+    ("c.id", "ID"),
+    ("c.id_caja", "ID Caja"),
+    ("c.codigo_caja", "Código Caja"),
+    ("d.nombre", "Departamento"),
+    ("c.años", "Años"),
+    ("t.nombre", "Tipo"),
+    ("c.observacion", "Observación"),
+    ("c.descripcion", "Descripción"),
+    ("b.nombre", "Bodega"),
+    ("u.nombre", "Ubicación"),
+    ("c.percha", "Percha"),
+    ("c.fila", "Fila"),
+    ("c.columna", "Columna"),
+]
+
+# Ids por consulta al exportar una selección (por debajo del límite de parámetros de SQLite)
+EXPORTACION_TAMANO_BLOQUE = 500
+
+def _consulta_exportacion(filtro):
+    columnas = ", ".join(expresion for expresion, _ in COLUMNAS_EXPORTACION)
+    return f"""
+        SELECT {columnas}
         FROM cajas c
         LEFT JOIN departamentos d ON c.departamento_id = d.id
         LEFT JOIN tipos t ON c.tipo_id = t.id
         LEFT JOIN bodegas b ON c.bodega_id = b.id
         LEFT JOIN ubicaciones u ON c.ubicacion_id = u.id
-        WHERE c.id_caja LIKE ? 
-        OR c.codigo_caja LIKE ? 
-        OR d.nombre LIKE ? 
-        OR c.años LIKE ? 
-        OR t.nombre LIKE ? 
-        OR c.observacion LIKE ? 
-        OR c.descripcion LIKE ? 
-        OR b.nombre LIKE ? 
-        OR u.nombre LIKE ? 
-        OR c.percha LIKE ? 
-        OR c.fila LIKE ? 
-        OR c.columna LIKE ?
-        LIMIT ? OFFSET ?
-    """, (search_pattern, search_pattern, search_pattern, 
-          search_pattern, search_pattern, search_pattern,
-          search_pattern, search_pattern, search_pattern,
-          search_pattern, search_pattern, search_pattern,
-          per_page, offset)).fetchall()
-    conn.close()
-    return cajas, total
+        WHERE {filtro}
+        ORDER BY c.numero_caja, c.id
+    """
+
+def iterar_cajas_exportacion(caja_ids=None, search_term=None):
+    """
+    Genera las filas (tuplas) de las cajas a exportar leyendo el cursor por bloques.
+
+    Con caja_ids se consultan por bloques de EXPORTACION_TAMANO_BLOQUE ids; si no,
+    se exportan todas las cajas que coinciden con search_term (o todas si está vacío).
+    La memoria usada no depende del número de cajas.
+    """
+    conn = get_db_connection()
+    try:
+        if caja_ids is None:
+            filtro, params = _filtro_busqueda_cajas(search_term)
+            consultas = [(_consulta_exportacion(filtro), params)]
+        else:
+            ids = sorted({int(caja_id) for caja_id in caja_ids})
+            consultas = []
+            for inicio in range(0, len(ids), EXPORTACION_TAMANO_BLOQUE):
+                bloque = ids[inicio:inicio + EXPORTACION_TAMANO_BLOQUE]
+                marcadores = ", ".join("?" * len(bloque))
+                consultas.append((_consulta_exportacion(f"c.id IN ({marcadores})"), bloque))
+        for sql, params in consultas:
+            cursor = conn.execute(sql, params)
+            while True:
+                filas = cursor.fetchmany(EXPORTACION_TAMANO_BLOQUE)
+                if not filas:
+                    break
+                for fila in filas:
+                    yield tuple(fila)
+    finally:
+        conn.close()
+
+def exportar_csv(filas):
+    """Genera el CSV en trozos de texto, listo para enviarlo como respuesta en streaming."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    # BOM para que Excel reconozca el UTF-8 al abrir el CSV
+    buffer.write("\ufeff")
+    escritor.writerow([encabezado for _, encabezado in COLUMNAS_EXPORTACION])
+    for numero, fila in enumerate(filas, start=1):
+        escritor.writerow(fila)
+        if numero % EXPORTACION_TAMANO_BLOQUE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def exportar_xlsx(filas):
+    """
+    Escribe las filas en un libro openpyxl de solo escritura y devuelve el archivo abierto.
+
+    Un XLSX es un zip y no puede enviarse mientras se escribe, así que se guarda en un
+    archivo temporal anónimo (sin nombre en disco) que se borra al cerrarse la respuesta.
+    """
+    libro = openpyxl.Workbook(write_only=True)
+    hoja = libro.create_sheet("Cajas")
+    hoja.append([encabezado for _, encabezado in COLUMNAS_EXPORTACION])
+    for fila in filas:
+        hoja.append(fila)
+    archivo = tempfile.TemporaryFile()
+    libro.save(archivo)
+    archivo.seek(0)
+    return archivo
 
 @app.route("/exportar_seleccionados", methods=["POST"])
 @login_required
 def exportar_seleccionados():
-    # Obtener los IDs de las cajas seleccionadas
-    cajas_ids = request.form.getlist('cajas_seleccionadas')
-    
-    if not cajas_ids:
-        flash("No se seleccionaron cajas para exportar", "warning")
-        return redirect(url_for('cajas'))
-    
-    # Obtener los datos de las cajas seleccionadas
-    cajas_data = []
-    for caja_id in cajas_ids:
-        caja = get_caja_by_id(caja_id)
-        if caja:
-            cajas_data.append({
-                'ID': caja['id'],
-                'ID Caja': caja['id_caja'],
-                'Código Caja': caja['codigo_caja'],
-                'Departamento': caja['departamento'],
-                'Años': caja['años'],
-                'Tipo': caja['tipo'],
-                'Observación': caja['observacion'],
-                'Descripción': caja['descripcion'],
-                'Bodega': caja['bodega'],
-                'Ubicación': caja['ubicacion'],
-                'Percha': caja['percha'],
-                'Fila': caja['fila'],
-                'Columna': caja['columna']
-            })
-    
-    # Crear un DataFrame con los datos
-    df = pd.DataFrame(cajas_data)
-    
-    # Generar un nombre de archivo único
+    if request.form.get('todos_los_resultados'):
+        # Exportar todo lo que coincide con la búsqueda actual, sin enviar los ids
+        filas = iterar_cajas_exportacion(search_term=request.form.get('search', '').strip())
+    else:
+        # Obtener los IDs de las cajas seleccionadas
+        cajas_ids = [caja_id for caja_id in request.form.getlist('cajas_seleccionadas') if caja_id.isdigit()]
+
+        if not cajas_ids:
+            flash("No se seleccionaron cajas para exportar", "warning")
+            return redirect(url_for('cajas'))
+
+        filas = iterar_cajas_exportacion(caja_ids=cajas_ids)
+
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"cajas_exportadas_{timestamp}.xlsx"
-    file_path = os.path.join(EXPORT_FOLDER, filename)
-    
-    # Guardar el DataFrame como archivo Excel
-    df.to_excel(file_path, index=False)
-    
-    # Enviar el archivo al usuario
-    return send_from_directory(directory=os.path.abspath(EXPORT_FOLDER), path=filename, as_attachment=True)
+    if request.form.get('formato') == 'csv':
+        respuesta = Response(stream_with_context(exportar_csv(filas)), mimetype="text/csv")
+        respuesta.headers["Content-Disposition"] = f"attachment; filename=cajas_exportadas_{timestamp}.csv"
+        return respuesta
+
+    return send_file(exportar_xlsx(filas), as_attachment=True,
+                     download_name=f"cajas_exportadas_{timestamp}.xlsx",
+                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
-def get_all_cajas(page=1, per_page=50):
+# ========================================================
+# Caché de conteos del listado de cajas
+# ========================================================
+# clave de _clave_conteo -> (generación, total, aproximado); se descarta cuando cambia la generación
+_cache_conteos = OrderedDict()
+_cache_conteos_lock = threading.Lock()
+MAX_CONTEOS_EN_CACHE = 256
+# Tamaño de los tramos de id en los que se divide un conteo con LIKE
+TRAMO_CONTEO = 5000
+
+def get_generacion_cajas(conn):
+    """Contador que los triggers de cajas (y de nombres de catálogos) incrementan en cada escritura."""
+    return conn.execute("SELECT valor FROM metadatos WHERE clave = 'cajas_generacion'").fetchone()[0]
+
+def _clave_conteo(search_term):
+    """Clave de caché a partir de lo que realmente se consulta, como en
+    _filtro_busqueda_cajas: la expresión MATCH de FTS (palabras ya separadas, sin
+    espacios sobrantes) o, para LIKE, el término tal cual, porque LIKE distingue
+    espacios y mayúsculas de letras no ASCII."""
+    if not search_term:
+        return ("todas",)
+    consulta_fts = construir_consulta_fts(search_term)
+    if consulta_fts is not None:
+        return ("fts", consulta_fts)
+    return ("like", search_term)
+
+def _contar_like_por_tramos(conn, search_term, presupuesto):
+    """Cuenta las coincidencias con LIKE recorriendo cajas por tramos de id.
+    Si se agota el presupuesto de tiempo, extrapola lo contado al rango completo
+    y devuelve (estimado, True)."""
+    filtro, params = _filtro_like_cajas(search_term)
+    min_id, max_id = conn.execute("SELECT MIN(id), MAX(id) FROM cajas").fetchone()
+    if min_id is None:
+        return 0, False
+    inicio = time.monotonic()
+    total = 0
+    desde = min_id
+    while desde <= max_id:
+        hasta = desde + TRAMO_CONTEO - 1
+        total += conn.execute(f"""
+            SELECT COUNT(*)
+            FROM cajas c
+            LEFT JOIN departamentos d ON c.departamento_id = d.id
+            LEFT JOIN tipos t ON c.tipo_id = t.id
+            LEFT JOIN bodegas b ON c.bodega_id = b.id
+            LEFT JOIN ubicaciones u ON c.ubicacion_id = u.id
+            WHERE c.id BETWEEN ? AND ? AND {filtro}
+        """, [desde, hasta] + params).fetchone()[0]
+        desde = hasta + 1
+        if desde <= max_id and time.monotonic() - inicio > presupuesto:
+            recorrido = desde - min_id
+            return round(total * (max_id - min_id + 1) / recorrido), True
+    return total, False
+
+def count_cajas(search_term=''):
+    """Total de cajas que coinciden con el término de búsqueda (todas si está vacío).
+    Devuelve (total, aproximado). El resultado se guarda en caché hasta la siguiente
+    escritura en cajas; aproximado es True si el conteo exacto excedía
+    CONTEO_PRESUPUESTO_SEGUNDOS y el total es una estimación."""
+    clave = _clave_conteo(search_term)
     conn = get_db_connection()
-    # Calcular el offset para la paginación
-    offset = (page - 1) * per_page
-    
-    # Obtener el total de cajas para la paginación
-    total = conn.execute("SELECT COUNT(*) FROM cajas").fetchone()[0]
-    
-    # Obtener las cajas para la página actual
-    cajas = conn.execute("""
-        SELECT c.*, d.nombre as departamento, t.nombre as tipo, 
-        b.nombre as bodega, u.nombre as ubicacion 
-        FROM cajas c
-        LEFT JOIN departamentos d ON c.departamento_id = d.id
-        LEFT JOIN tipos t ON c.tipo_id = t.id
-        LEFT JOIN bodegas b ON c.bodega_id = b.id
-        LEFT JOIN ubicaciones u ON c.ubicacion_id = u.id
-        LIMIT ? OFFSET ?
-    """, (per_page, offset)).fetchall()
+    generacion = get_generacion_cajas(conn)
+    with _cache_conteos_lock:
+        guardado = _cache_conteos.get(clave)
+        if guardado and guardado[0] == generacion:
+            _cache_conteos.move_to_end(clave)
+            conn.close()
+            return guardado[1], guardado[2]
+
+    aproximado = False
+    if clave[0] == "todas":
+        total = conn.execute("SELECT COUNT(*) FROM cajas").fetchone()[0]
+    elif clave[0] == "fts":
+        total = conn.execute("SELECT COUNT(*) FROM cajas_fts WHERE cajas_fts MATCH ?", (clave[1],)).fetchone()[0]
+    else:
+        total, aproximado = _contar_like_por_tramos(conn, search_term, app.config['CONTEO_PRESUPUESTO_SEGUNDOS'])
     conn.close()
-    
-    return cajas, total
+
+    with _cache_conteos_lock:
+        _cache_conteos[clave] = (generacion, total, aproximado)
+        _cache_conteos.move_to_end(clave)
+        while len(_cache_conteos) > MAX_CONTEOS_EN_CACHE:
+            _cache_conteos.popitem(last=False)
+    return total, aproximado
+
+# ========================================================
+# Paginación por cursor (keyset) del listado de cajas
+# ========================================================
+def encode_cursor(caja):
+    """Token opaco con la clave de orden (número de caja, id) de una fila.
+    Un número de caja NULL (caja sin id_caja) se codifica vacío."""
+    numero = "" if caja['numero_caja'] is None else caja['numero_caja']
+    clave = f"{numero}:{caja['id']}"
+    return base64.urlsafe_b64encode(clave.encode()).decode().rstrip("=")
+
+def decode_cursor(token):
+    """Devuelve la clave (número de caja o None, id) de un token, o None si no es válido."""
+    if not token:
+        return None
+    try:
+        relleno = "=" * (-len(token) % 4)
+        numero, caja_id = base64.urlsafe_b64decode(token + relleno).decode().split(":")
+        return (int(numero) if numero else None), int(caja_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return None
+
+def _tramos_keyset(after=None, before=None):
+    """Condiciones (WHERE, parámetros, dirección) que, leídas en orden, dan las filas
+    siguientes o anteriores a la clave. SQLite ordena los NULL primero, así que las
+    cajas sin número van antes que todas las demás; cada tramo es un rango del
+    índice idx_cajas_numero, porque una comparación de tuplas con NULL no coincide
+    con nada y un OR impediría acotar el rango."""
+    if before is not None:
+        numero, caja_id = before
+        if numero is None:
+            return [("c.numero_caja IS NULL AND c.id < ?", [caja_id], "DESC")]
+        # La primera condición acota el rango del índice; la comparación de tuplas desempata por id
+        return [("c.numero_caja <= ? AND (c.numero_caja, c.id) < (?, ?)", [numero, numero, caja_id], "DESC"),
+                ("c.numero_caja IS NULL", [], "DESC")]
+    if after is not None:
+        numero, caja_id = after
+        if numero is None:
+            return [("c.numero_caja IS NULL AND c.id > ?", [caja_id], "ASC"),
+                    ("c.numero_caja IS NOT NULL", [], "ASC")]
+        return [("c.numero_caja >= ? AND (c.numero_caja, c.id) > (?, ?)", [numero, numero, caja_id], "ASC")]
+    return [("1", [], "ASC")]
+
+def get_cajas_keyset(search_term='', per_page=50, after=None, before=None):
+    """Página de cajas ordenada por (número de caja, id) a partir de un cursor.
+    Con after se devuelven las filas siguientes a esa clave; con before, las anteriores.
+    El costo no depende de la profundidad de la página porque cada consulta
+    arranca directamente en el índice idx_cajas_numero.
+    Devuelve (cajas, hay_anterior, hay_siguiente)."""
+    filtro, params = _filtro_busqueda_cajas(search_term)
+    conn = get_db_connection()
+    cajas = []
+    for condicion, params_clave, orden in _tramos_keyset(after, before):
+        # Se pide una fila extra para saber si hay más páginas en esa dirección
+        faltan = per_page + 1 - len(cajas)
+        if faltan <= 0:
+            break
+        cajas += conn.execute(
+            SQL_LISTADO_CAJAS.format(filtro=f"{filtro} AND {condicion}", orden=f"c.numero_caja {orden}, c.id {orden}"),
+            params + params_clave + [faltan, 0]
+        ).fetchall()
+    conn.close()
+
+    hay_mas = len(cajas) > per_page
+    cajas = cajas[:per_page]
+    if before is not None:
+        cajas.reverse()
+        return cajas, hay_mas, True
+    return cajas, after is not None, hay_mas
 
 def add_prestamo(caja_id, item, loan_date, due_date, email):
     conn = get_db_connection()
@@ -651,93 +1902,678 @@ def get_prestamo_by_id(prestamo_id):
     conn.close()
     return prestamo
 
-def get_all_prestamos():
+# ========================================================
+# Listado de préstamos: filtros y paginación por cursor
+# ========================================================
+ESTADOS_PRESTAMO = [("", "Todos"), ("abiertos", "Sin devolver"), ("vencidos", "Vencidos"), ("devueltos", "Devueltos")]
+PRESTAMOS_POR_PAGINA_MAX = 500
+
+def _filtro_prestamos(estado="", desde=None, hasta=None, email="", id_caja=""):
+    """Cláusula WHERE y parámetros para los filtros del listado de préstamos.
+    desde y hasta acotan la fecha de préstamo (ambas inclusive)."""
+    condiciones, params = [], []
+    if estado == "abiertos":
+        condiciones.append("p.returned = 0")
+    elif estado == "vencidos":
+        condiciones.append("p.returned = 0 AND p.due_date < ?")
+        params.append(datetime.date.today().isoformat())
+    elif estado == "devueltos":
+        condiciones.append("p.returned = 1")
+    if desde:
+        condiciones.append("p.loan_date >= ?")
+        params.append(desde)
+    if hasta:
+        condiciones.append("p.loan_date <= ?")
+        params.append(hasta)
+    if email:
+        condiciones.append("p.email LIKE ?")
+        params.append(f"%{email}%")
+    if id_caja:
+        condiciones.append("c.id_caja = ?")
+        params.append(id_caja)
+    return " AND ".join(condiciones) or "1", params
+
+SQL_PRESTAMOS_PAGINA = """
+    SELECT p.*, c.id_caja, d.nombre AS departamento
+    FROM prestamos p
+    LEFT JOIN cajas c ON p.caja_id = c.id
+    LEFT JOIN departamentos d ON c.departamento_id = d.id
+    WHERE {filtro}
+    ORDER BY p.id {orden}
+    LIMIT ?
+"""
+
+def get_prestamos_pagina(filtros, per_page=50, after=None, before=None):
+    """Página de préstamos, del más reciente al más antiguo, con la caja y su departamento.
+    after/before son el id del último/primer préstamo de la página vista; como el
+    orden es por id, cada página arranca directamente en el índice.
+    Devuelve (prestamos, hay_anterior, hay_siguiente)."""
+    filtro, params = _filtro_prestamos(**filtros)
+    if before is not None:
+        condicion, orden, params_clave = "p.id > ?", "ASC", [before]
+    elif after is not None:
+        condicion, orden, params_clave = "p.id < ?", "DESC", [after]
+    else:
+        condicion, orden, params_clave = "1", "DESC", []
+
     conn = get_db_connection()
-    prestamos = conn.execute("SELECT * FROM prestamos").fetchall()
+    # Se pide una fila extra para saber si hay más páginas en esa dirección
+    prestamos = conn.execute(SQL_PRESTAMOS_PAGINA.format(filtro=f"{filtro} AND {condicion}", orden=orden),
+                             params + params_clave + [per_page + 1]).fetchall()
     conn.close()
-    return prestamos
+
+    hay_mas = len(prestamos) > per_page
+    prestamos = prestamos[:per_page]
+    if before is not None:
+        prestamos.reverse()
+        return prestamos, hay_mas, True
+    return prestamos, after is not None, hay_mas
+
+# ========================================================
+# Caché de catálogos (departamentos, tipos, bodegas, ubicaciones)
+# ========================================================
+# Los catálogos cambian pocas veces al mes. Se guardan en memoria junto con la
+# fila 'catalogos_version' de metadatos, que los triggers incrementan en cada
+# escritura; así cada proceso (p. ej. varios workers de gunicorn) detecta con una
+# sola consulta que otro proceso modificó un catálogo.
+
+TABLAS_CATALOGO = ("departamentos", "tipos", "bodegas", "ubicaciones")
+
+Catalogo = namedtuple("Catalogo", ["filas", "por_id", "por_nombre"])
+
+_cache_catalogos = {'version': None, 'tablas': {}}
+_cache_catalogos_lock = threading.Lock()
+
+def invalidar_catalogos():
+    """Descarta la caché local; se llama después de modificar un catálogo."""
+    with _cache_catalogos_lock:
+        _cache_catalogos['version'] = None
+
+def get_catalogo(tabla):
+    """Devuelve el Catalogo de la tabla: filas, mapa id→nombre y mapa nombre→id."""
+    conn = get_db_connection()
+    try:
+        version = conn.execute("SELECT valor FROM metadatos WHERE clave = 'catalogos_version'").fetchone()[0]
+        with _cache_catalogos_lock:
+            if _cache_catalogos['version'] == version:
+                return _cache_catalogos['tablas'][tabla]
+        # La versión se leyó antes que los datos: si alguien escribe entremedio,
+        # la próxima consulta verá una versión más nueva y volverá a cargar.
+        tablas = {}
+        for nombre in TABLAS_CATALOGO:
+            filas = conn.execute(f"SELECT * FROM {nombre}").fetchall()
+            tablas[nombre] = Catalogo(filas=filas,
+                                      por_id={f['id']: f['nombre'] for f in filas},
+                                      por_nombre={f['nombre']: f['id'] for f in filas})
+        with _cache_catalogos_lock:
+            _cache_catalogos['version'] = version
+            _cache_catalogos['tablas'] = tablas
+        return tablas[tabla]
+    finally:
+        conn.close()
 
 # Funciones para obtener datos de catálogos
 def get_departamentos():
+    return get_catalogo("departamentos").filas
+
+def get_tipos():
+    return get_catalogo("tipos").filas
+
+def get_bodegas():
+    return get_catalogo("bodegas").filas
+
+def get_ubicaciones():
+    return get_catalogo("ubicaciones").filas
+
+# ========================================================
+# Funciones para notificaciones y scheduler
+# ========================================================
+SQL_PRESTAMOS_POR_AVISAR = """
+    SELECT prestamos.id, prestamos.email, cajas.id_caja, prestamos.due_date
+    FROM prestamos
+    JOIN cajas ON prestamos.caja_id = cajas.id
+    WHERE prestamos.returned = 0 AND prestamos.proximo_aviso <= ?
+"""
+
+def check_overdue_loans(conn, hoy):
+    """Préstamos que vencieron desde el último chequeo o a los que les toca recordatorio.
+
+    Usa idx_prestamos_proximo_aviso, así que no recorre el historial de préstamos.
+    Deja proximo_aviso AVISO_INTERVALO_DIAS más adelante para no volver a
+    seleccionarlos; debe llamarse dentro de la transacción que encola los avisos.
+    """
+    overdue = conn.execute(SQL_PRESTAMOS_POR_AVISAR, (hoy,)).fetchall()
+    siguiente = (datetime.date.fromisoformat(hoy)
+                 + datetime.timedelta(days=app.config['AVISO_INTERVALO_DIAS'])).isoformat()
+    conn.executemany("UPDATE prestamos SET proximo_aviso = ? WHERE id = ?",
+                     [(siguiente, p["id"]) for p in overdue])
+    return overdue
+
+SQL_CONTAR_VENCIDOS = "SELECT COUNT(*) FROM prestamos WHERE returned = 0 AND due_date < ?"
+
+def contar_prestamos_vencidos():
+    """Cantidad de préstamos pendientes con fecha límite pasada (por idx_prestamos_vencimiento)."""
     conn = get_db_connection()
-    deps = conn.execute("SELECT * FROM departamentos").fetchall()
+    total = conn.execute(SQL_CONTAR_VENCIDOS, (datetime.date.today().isoformat(),)).fetchone()[0]
     conn.close()
-    return deps
+    return total
 
-def get_tipos():
+def _abrir_sesion_smtp():
+    """Abre una sesión SMTP autenticada según la configuración."""
+    servidor = smtplib.SMTP(app.config['SMTP_SERVIDOR'], app.config['SMTP_PUERTO'],
+                            timeout=app.config['SMTP_TIMEOUT'])
+    try:
+        if app.config['SMTP_STARTTLS']:
+            servidor.starttls()
+        if app.config['SMTP_USUARIO']:
+            servidor.login(app.config['SMTP_USUARIO'], app.config['SMTP_PASSWORD'])
+    except Exception:
+        servidor.close()
+        raise
+    return servidor
+
+def _cerrar_sesion_smtp(servidor):
+    try:
+        servidor.quit()
+    except Exception:
+        servidor.close()
+
+def _construir_mensaje(destinatario, asunto, cuerpo):
+    msg = MIMEText(cuerpo)
+    msg["Subject"] = asunto
+    msg["From"] = app.config['SMTP_REMITENTE']
+    msg["To"] = destinatario
+    return msg
+
+def error_smtp_transitorio(error):
+    """True si vale la pena reintentar: respuestas 4xx del servidor y fallos de
+    conexión o tiempo de espera. Las respuestas 5xx (dirección inexistente,
+    credenciales inválidas, mensaje rechazado) fallarían igual al reintentar."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # Un código por destinatario; basta con que uno sea definitivo
+        return all(400 <= codigo < 500 for codigo, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    # SMTPServerDisconnected, y socket.timeout / ConnectionError (subclases de OSError)
+    return isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+def _enviar_lote_smtp(lote):
+    """
+    Envía una lista de (destinatario, asunto, cuerpo) por una sola sesión SMTP.
+
+    Ante un error transitorio (ver error_smtp_transitorio) se cierra la sesión, se
+    espera con retroceso exponencial y se reintenta con una sesión nueva; ante uno
+    definitivo se pasa al siguiente mensaje sin reintentar. Devuelve una lista de
+    (mensaje, error) con error None si se envió.
+    """
+    resultados = []
+    servidor = None
+    try:
+        for mensaje in lote:
+            error = None
+            for intento in range(app.config['SMTP_REINTENTOS']):
+                try:
+                    if servidor is None:
+                        servidor = _abrir_sesion_smtp()
+                    servidor.send_message(_construir_mensaje(*mensaje))
+                    error = None
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    error = e
+                    # Un destinatario rechazado no invalida la sesión
+                    if servidor is not None and not isinstance(e, smtplib.SMTPRecipientsRefused):
+                        servidor.close()
+                        servidor = None
+                    if not error_smtp_transitorio(e):
+                        break
+                    if intento + 1 < app.config['SMTP_REINTENTOS']:
+                        espera = app.config['SMTP_ESPERA_REINTENTO'] * (2 ** intento)
+                        time.sleep(espera + random.uniform(0, espera / 2))
+            resultados.append((mensaje, error))
+    finally:
+        if servidor is not None:
+            _cerrar_sesion_smtp(servidor)
+    return resultados
+
+def enviar_correos(mensajes):
+    """
+    Envía (destinatario, asunto, cuerpo) repartidos en hasta SMTP_HILOS sesiones.
+
+    Cada hilo reutiliza una única sesión autenticada para todo su lote. Devuelve
+    la lista de (mensaje, error) en el mismo orden que mensajes.
+    """
+    mensajes = list(mensajes)
+    if not mensajes:
+        return []
+    hilos = max(1, min(app.config['SMTP_HILOS'], len(mensajes)))
+    lotes = [mensajes[i::hilos] for i in range(hilos)]
+    if hilos == 1:
+        por_lote = [_enviar_lote_smtp(lotes[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="smtp") as ejecutor:
+            por_lote = list(ejecutor.map(_enviar_lote_smtp, lotes))
+    # Volver a intercalar los resultados en el orden original
+    resultados = [None] * len(mensajes)
+    for i, lote in enumerate(por_lote):
+        for j, resultado in enumerate(lote):
+            resultados[i + j * hilos] = resultado
+    return resultados
+
+def send_email(recipient, subject, message):
+    (_, error), = enviar_correos([(recipient, subject, message)])
+    if error is None:
+        print("Correo enviado a", recipient)
+        return True
+    print("Error al enviar correo:", error)
+    return False
+
+def construir_resumenes_vencidos(prestamos):
+    """Agrupa los préstamos vencidos por correo y arma un único mensaje por destinatario."""
+    por_destinatario = OrderedDict()
+    for prestamo in prestamos:
+        por_destinatario.setdefault(prestamo["email"], []).append(prestamo)
+    mensajes = []
+    for email, vencidos in por_destinatario.items():
+        if len(vencidos) == 1:
+            asunto = f"Préstamo vencido: Caja {vencidos[0]['id_caja']}"
+        else:
+            asunto = f"{len(vencidos)} préstamos vencidos"
+        lineas = [f"- Caja {p['id_caja']}: venció el {p['due_date']}" for p in vencidos]
+        cuerpo = ("Los siguientes préstamos están vencidos:\n\n" + "\n".join(lineas) +
+                  "\n\nPor favor, gestionar la devolución a la brevedad.")
+        mensajes.append((email, asunto, cuerpo))
+    return mensajes
+
+# ========================================================
+# Bandeja de salida (outbox) y liderazgo entre procesos
+# ========================================================
+# Cualquier proceso puede encolar avisos (la restricción UNIQUE(prestamo_id, fecha)
+# evita duplicados), pero solo el que tiene el arrendamiento 'notificaciones' los
+# entrega. Además, cada fila se reclama con un UPDATE condicional antes de enviarla,
+# así que dos procesos nunca envían la misma.
+
+# Identificador de este proceso para los arrendamientos. Se calcula al usarlo y se
+# recalcula si cambió el PID: los procesos que un servidor crea con fork después de
+# importar la app no deben compartir el identificador del padre.
+_identidad_proceso = {'pid': None, 'id': None}
+
+def id_proceso():
+    pid = os.getpid()
+    if _identidad_proceso['pid'] != pid:
+        _identidad_proceso.update(pid=pid, id=f"{socket.gethostname()}:{pid}:{uuid.uuid4().hex[:8]}")
+    return _identidad_proceso['id']
+
+def tomar_liderazgo(nombre, segundos=None):
+    """Toma o renueva el arrendamiento `nombre`; devuelve True si este proceso es el líder."""
+    segundos = segundos or app.config['LIDER_ARRENDAMIENTO_SEGUNDOS']
+    ahora = time.time()
     conn = get_db_connection()
-    ts = conn.execute("SELECT * FROM tipos").fetchall()
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("""
+        INSERT INTO arrendamientos (nombre, duenio, vence) VALUES (?, ?, ?)
+        ON CONFLICT(nombre) DO UPDATE SET duenio = excluded.duenio, vence = excluded.vence
+        WHERE arrendamientos.duenio = excluded.duenio OR arrendamientos.vence < ?
+    """, (nombre, id_proceso(), ahora + segundos, ahora))
+    duenio = conn.execute("SELECT duenio FROM arrendamientos WHERE nombre = ?", (nombre,)).fetchone()[0]
+    conn.commit()
     conn.close()
-    return ts
+    return duenio == id_proceso()
+
+@atexit.register
+def liberar_liderazgos():
+    """Al terminar el proceso, suelta sus arrendamientos para que otro proceso tome
+    las tareas enseguida en lugar de esperar a que venzan."""
+    if _identidad_proceso['pid'] != os.getpid():
+        # Este proceso nunca tomó un arrendamiento
+        return
+    try:
+        conn = get_db_connection()
+        conn.execute("DELETE FROM arrendamientos WHERE duenio = ?", (id_proceso(),))
+        conn.commit()
+        conn.close()
+    except sqlite3.Error:
+        # Si la base está ocupada, el arrendamiento simplemente vence
+        pass
 
-def get_bodegas():
+def encolar_avisos_vencidos():
+    """Agrega a la outbox un aviso por préstamo que lo necesita hoy. Devuelve cuántos eran nuevos."""
+    hoy = datetime.date.today().isoformat()
     conn = get_db_connection()
-    bds = conn.execute("SELECT * FROM bodegas").fetchall()
+    # Seleccionar, encolar y adelantar proximo_aviso en una sola transacción
+    conn.execute("BEGIN IMMEDIATE")
+    vencidos = [p for p in check_overdue_loans(conn, hoy) if p["email"]]
+    antes = conn.total_changes
+    conn.executemany(
+        "INSERT OR IGNORE INTO outbox (prestamo_id, fecha, destinatario, id_caja, due_date, creado) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(p["id"], hoy, p["email"], p["id_caja"], p["due_date"], _ahora()) for p in vencidos]
+    )
+    nuevos = conn.total_changes - antes
+    conn.commit()
     conn.close()
-    return bds
+    return nuevos
+
+def _reclamar_lote_outbox(conn):
+    """Marca como 'enviando' el siguiente lote de avisos pendientes y lo devuelve."""
+    ahora = _ahora()
+    conn.execute("BEGIN IMMEDIATE")
+    # Ordenar por destinatario mantiene juntos los avisos de un mismo resumen
+    reclamados = conn.execute("""
+        UPDATE outbox SET estado = 'enviando', reclamado_en = ?
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE estado = 'pendiente' AND (proximo_intento IS NULL OR proximo_intento <= ?)
+            ORDER BY destinatario, id LIMIT ?
+        )
+        RETURNING id, prestamo_id, destinatario AS email, id_caja, due_date, intentos
+    """, (ahora, ahora, app.config['OUTBOX_LOTE'])).fetchall()
+    conn.commit()
+    return reclamados
 
-def get_ubicaciones():
+def entregar_outbox():
+    """
+    Entrega los avisos pendientes si este proceso es el líder.
+
+    Se trabaja por lotes de OUTBOX_LOTE filas; cada lote se agrupa en un resumen por
+    destinatario. Devuelve (enviados, fallidos) o None si otro proceso es el líder.
+    """
+    if not tomar_liderazgo("notificaciones"):
+        return None
+    enviados = fallidos = 0
     conn = get_db_connection()
-    ubs = conn.execute("SELECT * FROM ubicaciones").fetchall()
+    try:
+        # Filas que quedaron 'enviando' por un proceso que se cayó vuelven a la cola
+        limite = (datetime.datetime.now() - datetime.timedelta(
+            seconds=2 * app.config['LIDER_ARRENDAMIENTO_SEGUNDOS'])).isoformat(timespec="seconds")
+        conn.execute("UPDATE outbox SET estado = 'pendiente' WHERE estado = 'enviando' AND reclamado_en < ?", (limite,))
+        conn.commit()
+
+        while True:
+            lote = _reclamar_lote_outbox(conn)
+            if not lote:
+                break
+            mensajes = construir_resumenes_vencidos(lote)
+            errores = {mensaje[0]: error for mensaje, error in enviar_correos(mensajes)}
+            ahora = _ahora()
+            ok = [f for f in lote if errores[f["email"]] is None]
+            con_error = [f for f in lote if errores[f["email"]] is not None]
+            conn.executemany(
+                "UPDATE outbox SET estado = 'enviado', intentos = intentos + 1, enviado = ?, ultimo_error = NULL "
+                "WHERE id = ?",
+                [(ahora, f["id"]) for f in ok]
+            )
+            conn.executemany("UPDATE prestamos SET ultimo_aviso = ? WHERE id = ?",
+                             [(ahora, f["prestamo_id"]) for f in ok])
+            # Con error transitorio se reintenta más tarde (5, 10, 20... minutos); tras
+            # OUTBOX_MAX_INTENTOS, o ante un rechazo definitivo, el aviso queda 'fallido'
+            # para revisarlo a mano
+            conn.executemany(
+                "UPDATE outbox SET intentos = intentos + 1, ultimo_error = ?, proximo_intento = ?, "
+                "estado = CASE WHEN intentos + 1 >= ? THEN 'fallido' ELSE 'pendiente' END "
+                "WHERE id = ?",
+                [(str(errores[f["email"]]),
+                  (datetime.datetime.now() + datetime.timedelta(minutes=5 * 2 ** f["intentos"])).isoformat(timespec="seconds"),
+                  app.config['OUTBOX_MAX_INTENTOS'] if error_smtp_transitorio(errores[f["email"]]) else 0,
+                  f["id"]) for f in con_error]
+            )
+            conn.commit()
+            enviados += len(ok)
+            fallidos += len(con_error)
+            # Renovar el arrendamiento; si otro proceso lo tomó, se deja de entregar
+            if not tomar_liderazgo("notificaciones"):
+                break
+    finally:
+        conn.close()
+    return enviados, fallidos
+
+def notify_overdue_loans():
+    nuevos = encolar_avisos_vencidos()
+    inicio = time.perf_counter()
+    resultado = entregar_outbox()
+    if resultado is None:
+        print(f"Avisos de vencimiento: {nuevos} encolados; otro proceso se encarga de enviarlos")
+        return resultado
+    enviados, fallidos = resultado
+    print(f"Avisos de vencimiento: {nuevos} encolados, {enviados} entregados, {fallidos} con error "
+          f"({time.perf_counter() - inicio:.1f}s)")
+    return resultado
+
+# ========================================================
+# Planificador de tareas periódicas
+# ========================================================
+# Cada proceso tiene un hilo que duerme hasta la próxima tarea de la agenda (un
+# montículo ordenado por hora), pero solo ejecuta el que tiene el arrendamiento
+# 'planificador'. La última ejecución de cada tarea se guarda en
+# tareas_programadas, así que un nuevo líder continúa la agenda del anterior y
+# /admin/jobs la muestra desde cualquier proceso.
+Tarea = namedtuple("Tarea", ["nombre", "funcion", "descripcion", "cada", "a_las", "dias"])
+
+_tareas = {}
+_agenda = []  # montículo de (timestamp, nombre)
+_agenda_lock = threading.Lock()
+_agenda_evento = threading.Event()
+_planificador_hilo = None
+
+def registrar_tarea(nombre, funcion, descripcion, cada=None, a_las=None, dias=1):
+    """Registra una tarea que se ejecuta cada `cada` segundos, o a la hora `a_las`
+    ("HH:MM") cada `dias` días."""
+    _tareas[nombre] = Tarea(nombre, funcion, descripcion, cada, a_las, dias)
+    # Si el hilo ya corre, la agenda se reconstruye en su próxima vuelta
+    _agenda_evento.set()
+
+def describir_frecuencia(tarea):
+    if tarea.cada:
+        return f"cada {tarea.cada // 60} min" if tarea.cada % 60 == 0 else f"cada {tarea.cada} s"
+    if tarea.dias == 1:
+        return f"diaria a las {tarea.a_las}"
+    return f"cada {tarea.dias} días a las {tarea.a_las}"
+
+def proxima_ejecucion(tarea, ultima=None):
+    """Fecha y hora de la siguiente ejecución de `tarea` después de `ultima` (ISO o None)."""
+    ahora = datetime.datetime.now()
+    ultima = datetime.datetime.fromisoformat(ultima) if ultima else None
+    if tarea.cada:
+        # Si el proceso estuvo detenido, la tarea atrasada corre una sola vez al arrancar
+        return (ultima or ahora) + datetime.timedelta(seconds=tarea.cada)
+    hora = datetime.time.fromisoformat(tarea.a_las)
+    dia = ultima.date() + datetime.timedelta(days=tarea.dias) if ultima else ahora.date()
+    proxima = datetime.datetime.combine(dia, hora)
+    while proxima <= ahora:
+        proxima += datetime.timedelta(days=1)
+    return proxima
+
+def get_estado_tareas():
+    """Fila de tareas_programadas de cada tarea registrada (o None si nunca corrió)."""
+    conn = get_db_connection()
+    filas = {fila["nombre"]: fila for fila in conn.execute("SELECT * FROM tareas_programadas").fetchall()}
     conn.close()
-    return ubs
+    return {nombre: filas.get(nombre) for nombre in _tareas}
+
+def ejecutar_tarea(nombre):
+    """Ejecuta una tarea y registra duración, resultado o error. Devuelve la fecha de inicio (ISO)."""
+    tarea = _tareas[nombre]
+    inicio_iso = _ahora()
+    inicio = time.perf_counter()
+    resultado = error = None
+    try:
+        # Un contexto de aplicación por ejecución: la conexión se libera al terminar
+        with app.app_context():
+            resultado = tarea.funcion()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        print(f"Error en la tarea {nombre}: {error}")
+    duracion = time.perf_counter() - inicio
+    conn = get_db_connection()
+    conn.execute("""
+        INSERT INTO tareas_programadas (nombre, ultima_ejecucion, duracion, resultado, ultimo_error, ejecuciones)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON CONFLICT(nombre) DO UPDATE SET ultima_ejecucion = excluded.ultima_ejecucion,
+            duracion = excluded.duracion, resultado = excluded.resultado,
+            ultimo_error = excluded.ultimo_error, ejecuciones = ejecuciones + 1
+    """, (nombre, inicio_iso, duracion, None if resultado is None else str(resultado)[:500], error))
+    conn.commit()
+    conn.close()
+    return inicio_iso
+
+def _reconstruir_agenda():
+    agenda = []
+    for nombre, fila in get_estado_tareas().items():
+        ultima = fila["ultima_ejecucion"] if fila else None
+        agenda.append((proxima_ejecucion(_tareas[nombre], ultima).timestamp(), nombre))
+    heapq.heapify(agenda)
+    with _agenda_lock:
+        _agenda[:] = agenda
+
+def _bucle_planificador():
+    era_lider = False
+    while True:
+        reconstruir = _agenda_evento.is_set()
+        _agenda_evento.clear()
+        try:
+            es_lider = tomar_liderazgo("planificador")
+            # Al tomar el liderazgo, otro proceso pudo haber corrido tareas mientras tanto
+            if es_lider and (not era_lider or reconstruir):
+                _reconstruir_agenda()
+            era_lider = es_lider
+            while es_lider:
+                with _agenda_lock:
+                    if not _agenda or _agenda[0][0] > time.time():
+                        break
+                    _, nombre = heapq.heappop(_agenda)
+                ultima = ejecutar_tarea(nombre)
+                with _agenda_lock:
+                    heapq.heappush(_agenda, (proxima_ejecucion(_tareas[nombre], ultima).timestamp(), nombre))
+                # Una tarea larga pudo consumir el arrendamiento
+                es_lider = era_lider = tomar_liderazgo("planificador")
+        except Exception as e:
+            # El hilo no debe morir: se reintenta en la próxima vuelta
+            print("Error en el planificador:", e)
+            era_lider = False
+        # El líder despierta al menos tres veces por arrendamiento para renovarlo;
+        # los demás procesos, con la misma frecuencia, para relevarlo si se cae.
+        renovar_cada = app.config['LIDER_ARRENDAMIENTO_SEGUNDOS'] / 3
+        with _agenda_lock:
+            siguiente = _agenda[0][0] - time.time() if _agenda and era_lider else renovar_cada
+        _agenda_evento.wait(min(max(siguiente, 0), renovar_cada))
+
+def iniciar_planificador():
+    """Arranca el hilo del planificador en este proceso, una sola vez."""
+    global _planificador_hilo
+    if _planificador_hilo is not None or not app.config['PLANIFICADOR_ACTIVO']:
+        return
+    with _agenda_lock:
+        if _planificador_hilo is not None:
+            return
+        _planificador_hilo = threading.Thread(target=_bucle_planificador, name="planificador", daemon=True)
+        _planificador_hilo.start()
+    print("Planificador de tareas iniciado...")
+
+# Bajo un servidor WSGI no se llama a run_app: cada proceso arranca su hilo con
+# la primera petición y el arrendamiento decide cuál ejecuta las tareas.
+@app.before_request
+def arrancar_planificador():
+    iniciar_planificador()
 
 # ========================================================
-# Funciones para notificaciones y scheduler (sin cambios)
+# Trabajos en segundo plano (importación de Excel)
 # ========================================================
-def check_overdue_loans():
-    today = datetime.date.today().isoformat()
+_ejecutor_trabajos = ThreadPoolExecutor(max_workers=app.config['TRABAJOS_MAX_HILOS'],
+                                        thread_name_prefix="trabajos")
+
+def _ahora():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+def crear_trabajo(tipo, usuario_id=None):
+    trabajo_id = uuid.uuid4().hex
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT prestamos.id, prestamos.email, cajas.id_caja, prestamos.due_date 
-        FROM prestamos 
-        JOIN cajas ON prestamos.caja_id = cajas.id 
-        WHERE prestamos.returned = 0 AND prestamos.due_date < ?
-    """, (today,))
-    overdue = cursor.fetchall()
+    conn.execute("INSERT INTO trabajos (id, tipo, usuario_id, creado, actualizado) VALUES (?, ?, ?, ?, ?)",
+                 (trabajo_id, tipo, usuario_id, _ahora(), _ahora()))
+    conn.commit()
     conn.close()
-    return overdue
+    return trabajo_id
+
+def get_trabajo(trabajo_id):
+    conn = get_db_connection()
+    trabajo = conn.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+    conn.close()
+    return trabajo
+
+def actualizar_trabajo(trabajo_id, **campos):
+    campos["actualizado"] = _ahora()
+    asignaciones = ", ".join(f"{campo} = ?" for campo in campos)
+    conn = get_db_connection()
+    conn.execute(f"UPDATE trabajos SET {asignaciones} WHERE id = ?", list(campos.values()) + [trabajo_id])
+    conn.commit()
+    conn.close()
+
+def marcar_trabajos_interrumpidos():
+    """Da por fallidos los trabajos que quedaron a medias por un reinicio.
+    Los hilos del ejecutor mueren con el proceso, así que esos trabajos nunca
+    terminarían y la página de importación consultaría su estado para siempre.
+    Solo se tocan los que llevan TRABAJOS_INACTIVO_MINUTOS sin avanzar, para no
+    interferir con los que siguen en marcha en otro proceso del servidor."""
+    limite = (datetime.datetime.now()
+              - datetime.timedelta(minutes=app.config['TRABAJOS_INACTIVO_MINUTOS'])).isoformat(timespec="seconds")
+    conn = get_db_connection()
+    cursor = conn.execute("""
+        UPDATE trabajos SET estado = 'error', actualizado = ?,
+               mensaje = 'La importación se interrumpió al reiniciarse el servidor. Vuelva a subir el archivo.'
+        WHERE estado IN ('pendiente', 'en_proceso') AND actualizado < ?
+    """, (_ahora(), limite))
+    conn.commit()
+    conn.close()
+    if cursor.rowcount:
+        print(f"Se marcaron {cursor.rowcount} trabajos interrumpidos como fallidos.")
+
+if not PROCESO_AUXILIAR:
+    marcar_trabajos_interrumpidos()
+    # Las conexiones usadas al importar el módulo no deben quedar en el pool cuando
+    # el servidor haga fork de sus procesos
+    vaciar_pool()
+
+def encolar_importacion_excel(file_path, usuario_id=None):
+    """Registra un trabajo de importación y lo ejecuta en segundo plano. Devuelve su id."""
+    trabajo_id = crear_trabajo("importacion_excel", usuario_id)
+    _ejecutor_trabajos.submit(_ejecutar_importacion_excel, trabajo_id, file_path)
+    return trabajo_id
+
+def _ejecutar_importacion_excel(trabajo_id, file_path):
+    def progreso(leidas, insertadas, rechazadas, total):
+        actualizar_trabajo(trabajo_id, filas_leidas=leidas, insertadas=insertadas,
+                           rechazadas=rechazadas, total_filas=total)
+        # La cancelación se revisa entre lotes
+        return not get_trabajo(trabajo_id)["cancelar"]
 
-def send_email(recipient, subject, message):
-    smtp_server = "smtp.example.com"   # Configura tu servidor SMTP
-    smtp_port = 587
-    smtp_user = "tu_email@example.com"
-    smtp_password = "tu_password"
-    
-    msg = MIMEText(message)
-    msg["Subject"] = subject
-    msg["From"] = smtp_user
-    msg["To"] = recipient
-    
     try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
-        print("Correo enviado a", recipient)
+        actualizar_trabajo(trabajo_id, estado="en_proceso", iniciado=_ahora())
+        exito, mensaje, cancelado = procesar_excel_cajas(file_path, progreso=progreso)
+        if not exito:
+            estado = "error"
+        elif cancelado:
+            estado = "cancelado"
+        else:
+            estado = "completado"
+        actualizar_trabajo(trabajo_id, estado=estado, mensaje=mensaje)
     except Exception as e:
-        print("Error al enviar correo:", e)
-
-def notify_overdue_loans():
-    overdue_loans = check_overdue_loans()
-    for loan in overdue_loans:
-        loan_id, email, id_caja, due_date = loan
-        subject = f"Préstamo vencido: Caja {id_caja}"
-        message = (f"El préstamo de la caja {id_caja} venció el {due_date}.\n"
-                   "Por favor, gestionar la devolución a la brevedad.")
-        send_email(email, subject, message)
-
-def start_notification_scheduler():
-    schedule.every().day.at("09:00").do(notify_overdue_loans)
-    print("Scheduler de notificaciones iniciado...")
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+        actualizar_trabajo(trabajo_id, estado="error", mensaje=f"Error al procesar el archivo: {str(e)}")
+    finally:
+        # Eliminar el archivo después de procesarlo
+        if os.path.exists(file_path):
+            os.remove(file_path)
 
-def start_scheduler_thread():
-    scheduler_thread = threading.Thread(target=start_notification_scheduler, daemon=True)
-    scheduler_thread.start()
+def progreso_trabajo(trabajo):
+    """Estado de un trabajo como diccionario para la respuesta JSON, con ETA estimada."""
+    datos = {campo: trabajo[campo] for campo in
+             ("id", "tipo", "estado", "total_filas", "filas_leidas", "insertadas", "rechazadas", "mensaje", "creado")}
+    datos["porcentaje"] = None
+    datos["eta_segundos"] = None
+    if trabajo["total_filas"]:
+        datos["porcentaje"] = round(100 * trabajo["filas_leidas"] / trabajo["total_filas"], 1)
+    if trabajo["estado"] == "en_proceso" and trabajo["iniciado"] and trabajo["filas_leidas"]:
+        transcurrido = (datetime.datetime.now() - datetime.datetime.fromisoformat(trabajo["iniciado"])).total_seconds()
+        pendientes = (trabajo["total_filas"] or 0) - trabajo["filas_leidas"]
+        datos["eta_segundos"] = round(transcurrido / trabajo["filas_leidas"] * pendientes)
+    return datos
 
 # ========================================================
 # Rutas de Autenticación
@@ -749,7 +2585,9 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = get_user_by_username(form.username.data)
-        if user and check_password_hash(user.password, form.password.data):
+        if user and verificar_clave(user.password, form.password.data):
+            if necesita_rehash(user.password):
+                actualizar_hash_clave(user.id, form.password.data)
             login_user(user)
             flash("Bienvenido, " + user.username)
             return redirect(url_for("index"))
@@ -769,7 +2607,7 @@ def logout():
 def update_email():
     form = UpdateEmailForm()
     if form.validate_on_submit():
-        if check_password_hash(current_user.password, form.password.data):
+        if verificar_clave(current_user.password, form.password.data):
             # Verificar si el correo ya está en uso
             existing_user = get_user_by_email(form.email.data)
             if existing_user and existing_user.id != current_user.id:
@@ -855,7 +2693,7 @@ def cambiar_clave():
     if form.validate_on_submit():
         user = get_user_by_id(current_user.id)
         # Verificar que la contraseña actual sea correcta
-        if check_password_hash(user.password, form.current_password.data):
+        if verificar_clave(user.password, form.current_password.data):
             # Actualizar la contraseña
             update_user_password(user.id, form.new_password.data)
             flash("Tu contraseña ha sido actualizada correctamente", "success")
@@ -873,7 +2711,7 @@ def register():
         if get_user_by_username(form.username.data):
             flash("El usuario ya existe.")
         else:
-            hashed_password = generate_password_hash(form.password.data)
+            hashed_password = hashear_clave(form.password.data)
             conn = get_db_connection()
             conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", 
                          (form.username.data, hashed_password))
@@ -893,27 +2731,48 @@ def cargar_excel():
     form = ExcelUploadForm()
     
     if form.validate_on_submit():
-        # Guardar el archivo
+        # Guardar el archivo con un nombre único para no pisar otras cargas en curso
         archivo = form.archivo.data
-        filename = secure_filename(archivo.filename)
+        filename = f"{uuid.uuid4().hex}_{secure_filename(archivo.filename)}"
+        if os.path.splitext(filename)[1].lower() not in EXTENSIONES_IMPORTACION:
+            flash(f"Formato no soportado. Use: {', '.join(EXTENSIONES_IMPORTACION)}", 'danger')
+            return render_template('cargar_excel.html', form=form)
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        archivo.save(file_path)
+        # Werkzeug ya guarda las cargas grandes en un archivo temporal; se copian a disco por bloques
+        archivo.save(file_path, buffer_size=app.config['SUBIDA_TAMANO_BLOQUE'])
         
-        # Procesar el archivo
-        exito, mensaje = procesar_excel_cajas(file_path)
-        
-        # Eliminar el archivo después de procesarlo
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
-        if exito:
-            flash(mensaje, 'success')
-        else:
-            flash(mensaje, 'danger')
-            
-        return redirect(url_for('cajas'))
+        # Procesar el archivo en segundo plano
+        trabajo_id = encolar_importacion_excel(file_path, current_user.id)
+        return redirect(url_for('ver_trabajo', trabajo_id=trabajo_id))
     
     return render_template('cargar_excel.html', form=form)
+
+@app.route('/importacion/<trabajo_id>')
+@login_required
+def ver_trabajo(trabajo_id):
+    trabajo = get_trabajo(trabajo_id)
+    if not trabajo:
+        flash("Trabajo no encontrado.", "danger")
+        return redirect(url_for('cajas'))
+    return render_template('importacion.html', trabajo=trabajo)
+
+@app.route('/jobs/<trabajo_id>')
+@login_required
+def estado_trabajo(trabajo_id):
+    trabajo = get_trabajo(trabajo_id)
+    if not trabajo:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    return jsonify(progreso_trabajo(trabajo))
+
+@app.route('/jobs/<trabajo_id>/cancelar', methods=['POST'])
+@login_required
+def cancelar_trabajo(trabajo_id):
+    trabajo = get_trabajo(trabajo_id)
+    if not trabajo:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    if trabajo["estado"] in ("pendiente", "en_proceso"):
+        actualizar_trabajo(trabajo_id, cancelar=1)
+    return jsonify(progreso_trabajo(get_trabajo(trabajo_id)))
 @app.route("/")
 @login_required
 def index():
@@ -941,10 +2800,18 @@ def cajas():
         print(f"per_page fuera de rango, establecido a: {per_page}")
     # No hay límite superior, el usuario puede ver tantas cajas como desee
     
-    if search_term:
-        cajas, total = search_cajas(search_term, page, per_page)
-    else:
-        cajas, total = get_all_cajas(page, per_page)
+    # Todas las páginas se navegan por cursor (after/before), sin OFFSET; page solo
+    # es el número que se muestra. Sin cursor se empieza por la primera página.
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before'))
+    cajas, hay_anterior, hay_siguiente = get_cajas_keyset(search_term, per_page, after=after, before=before)
+    # Si el cursor llevó al principio, es la primera página aunque page diga otra cosa
+    page = max(page, 2) if hay_anterior else 1
+    # El conteo sale de la caché salvo que las cajas hayan cambiado
+    total, total_aproximado = count_cajas(search_term)
+    if total_aproximado:
+        # Una estimación nunca puede quedar por debajo de lo que ya se mostró
+        total = max(total, (page - 1) * per_page + len(cajas) + (1 if hay_siguiente else 0))
     
     # Calcular número total de páginas
     total_pages = (total + per_page - 1) // per_page
@@ -956,7 +2823,10 @@ def cajas():
         page=page, 
         total_pages=total_pages, 
         total=total,
-        per_page=per_page
+        total_aproximado=total_aproximado,
+        per_page=per_page,
+        prev_cursor=encode_cursor(cajas[0]) if cajas and hay_anterior else None,
+        next_cursor=encode_cursor(cajas[-1]) if cajas and hay_siguiente else None
     )
 
 @app.route("/add_caja", methods=["GET", "POST"])
@@ -1051,12 +2921,46 @@ def search_caja():
         cajas_result, _ = search_cajas(query)
     return render_template("search_caja.html", cajas=cajas_result, query=query)
 
-# Gestión de Préstamos (sin cambios significativos)
+def _fecha_filtro(valor):
+    """Fecha ISO de un parámetro de la URL, o None si falta o no es válida."""
+    try:
+        return datetime.date.fromisoformat(valor).isoformat() if valor else None
+    except ValueError:
+        return None
+
+# Gestión de Préstamos
 @app.route("/prestamos")
 @login_required
 def prestamos():
-    prestamos = get_all_prestamos()
-    return render_template("prestamos.html", prestamos=prestamos)
+    estado = request.args.get("estado", "")
+    filtros = {
+        "estado": estado if estado in dict(ESTADOS_PRESTAMO) else "",
+        "desde": _fecha_filtro(request.args.get("desde")),
+        "hasta": _fecha_filtro(request.args.get("hasta")),
+        "email": request.args.get("email", "").strip(),
+        "id_caja": request.args.get("caja", "").strip(),
+    }
+    per_page = request.args.get("per_page", 50, type=int)
+    per_page = min(max(per_page, 1), PRESTAMOS_POR_PAGINA_MAX)
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+
+    prestamos, hay_anterior, hay_siguiente = get_prestamos_pagina(filtros, per_page, after=after, before=before)
+    # Parámetros que los enlaces de paginación deben conservar
+    parametros = {clave: valor for clave, valor in request.args.items()
+                  if clave not in ("after", "before") and valor}
+    return render_template(
+        "prestamos.html",
+        prestamos=prestamos,
+        filtros=filtros,
+        estados=ESTADOS_PRESTAMO,
+        per_page=per_page,
+        parametros=parametros,
+        prev_cursor=prestamos[0]["id"] if prestamos and hay_anterior else None,
+        next_cursor=prestamos[-1]["id"] if prestamos and hay_siguiente else None,
+        hoy=datetime.date.today().isoformat(),
+        total_vencidos=contar_prestamos_vencidos(),
+    )
 
 @app.route("/add_prestamo", methods=["GET", "POST"])
 @login_required
@@ -1127,11 +3031,14 @@ def departamentos():
 @login_required
 def add_departamento():
     form = DepartamentoForm()
+    form.cover_template.choices = opciones_plantilla_portada()
     if form.validate_on_submit():
         conn = get_db_connection()
-        conn.execute("INSERT INTO departamentos (nombre) VALUES (?)", (form.nombre.data,))
+        conn.execute("INSERT INTO departamentos (nombre, cover_template) VALUES (?, ?)",
+                     (form.nombre.data, form.cover_template.data or None))
         conn.commit()
         conn.close()
+        invalidar_catalogos()
         flash("Departamento agregado.")
         return redirect(url_for("departamentos"))
     return render_template("add_departamento.html", form=form)
@@ -1146,13 +3053,17 @@ def edit_departamento(dep_id):
         flash("Departamento no encontrado.")
         return redirect(url_for("departamentos"))
     form = DepartamentoForm()
+    form.cover_template.choices = opciones_plantilla_portada()
     if request.method == "GET":
         form.nombre.data = dep["nombre"]
+        form.cover_template.data = dep["cover_template"] or ""
     if form.validate_on_submit():
         conn = get_db_connection()
-        conn.execute("UPDATE departamentos SET nombre = ? WHERE id = ?", (form.nombre.data, dep_id))
+        conn.execute("UPDATE departamentos SET nombre = ?, cover_template = ? WHERE id = ?",
+                     (form.nombre.data, form.cover_template.data or None, dep_id))
         conn.commit()
         conn.close()
+        invalidar_catalogos()
         flash("Departamento actualizado.")
         return redirect(url_for("departamentos"))
     return render_template("edit_departamento.html", form=form, departamento=dep)
@@ -1164,6 +3075,7 @@ def delete_departamento(dep_id):
     conn.execute("DELETE FROM departamentos WHERE id = ?", (dep_id,))
     conn.commit()
     conn.close()
+    invalidar_catalogos()
     flash("Departamento eliminado.")
     return redirect(url_for("departamentos"))
 
@@ -1183,6 +3095,7 @@ def add_tipo():
         conn.execute("INSERT INTO tipos (nombre) VALUES (?)", (form.nombre.data,))
         conn.commit()
         conn.close()
+        invalidar_catalogos()
         flash("Tipo agregado.")
         return redirect(url_for("tipos"))
     return render_template("add_tipo.html", form=form)
@@ -1204,6 +3117,7 @@ def edit_tipo(tipo_id):
         conn.execute("UPDATE tipos SET nombre = ? WHERE id = ?", (form.nombre.data, tipo_id))
         conn.commit()
         conn.close()
+        invalidar_catalogos()
         flash("Tipo actualizado.")
         return redirect(url_for("tipos"))
     return render_template("edit_tipo.html", form=form, tipo=t)
@@ -1215,6 +3129,7 @@ def delete_tipo(tipo_id):
     conn.execute("DELETE FROM tipos WHERE id = ?", (tipo_id,))
     conn.commit()
     conn.close()
+    invalidar_catalogos()
     flash("Tipo eliminado.")
     return redirect(url_for("tipos"))
 
@@ -1234,6 +3149,7 @@ def add_bodega():
         conn.execute("INSERT INTO bodegas (nombre, tamano) VALUES (?, ?)", (form.nombre.data, form.tamano.data))
         conn.commit()
         conn.close()
+        invalidar_catalogos()
         flash("Bodega agregada.")
         return redirect(url_for("bodegas"))
     return render_template("add_bodega.html", form=form)
@@ -1256,6 +3172,7 @@ def edit_bodega(bodega_id):
         conn.execute("UPDATE bodegas SET nombre = ?, tamano = ? WHERE id = ?", (form.nombre.data, form.tamano.data, bodega_id))
         conn.commit()
         conn.close()
+        invalidar_catalogos()
         flash("Bodega actualizada.")
         return redirect(url_for("bodegas"))
     return render_template("edit_bodega.html", form=form, bodega=bd)
@@ -1267,6 +3184,7 @@ def delete_bodega(bodega_id):
     conn.execute("DELETE FROM bodegas WHERE id = ?", (bodega_id,))
     conn.commit()
     conn.close()
+    invalidar_catalogos()
     flash("Bodega eliminada.")
     return redirect(url_for("bodegas"))
 
@@ -1286,6 +3204,7 @@ def add_ubicacion():
         conn.execute("INSERT INTO ubicaciones (nombre) VALUES (?)", (form.nombre.data,))
         conn.commit()
         conn.close()
+        invalidar_catalogos()
         flash("Ubicación agregada.")
         return redirect(url_for("ubicaciones"))
     return render_template("add_ubicacion.html", form=form)
@@ -1307,6 +3226,7 @@ def edit_ubicacion(ubicacion_id):
         conn.execute("UPDATE ubicaciones SET nombre = ? WHERE id = ?", (form.nombre.data, ubicacion_id))
         conn.commit()
         conn.close()
+        invalidar_catalogos()
         flash("Ubicación actualizada.")
         return redirect(url_for("ubicaciones"))
     return render_template("edit_ubicacion.html", form=form, ubicacion=ub)
@@ -1318,6 +3238,7 @@ def delete_ubicacion(ubicacion_id):
     conn.execute("DELETE FROM ubicaciones WHERE id = ?", (ubicacion_id,))
     conn.commit()
     conn.close()
+    invalidar_catalogos()
     flash("Ubicación eliminada.")
     return redirect(url_for("ubicaciones"))
 
@@ -1335,121 +3256,257 @@ def print_qr():
             flash("Los rangos deben ser numéricos, por ejemplo: 0001.")
             return redirect(url_for("print_qr"))
         conn = get_db_connection()
-        # Se hace CAST(id_caja AS INTEGER) para comparar numéricamente,
-        # ya que id_caja se guarda como texto con relleno de ceros.
-        cajas = conn.execute(
-            "SELECT cajas.*, departamentos.nombre AS departamento, tipos.nombre AS tipo "
-            "FROM cajas "
-            "LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id "
-            "LEFT JOIN tipos ON cajas.tipo_id = tipos.id "
-            "WHERE CAST(id_caja AS INTEGER) BETWEEN ? AND ? "
-            "ORDER BY CAST(id_caja AS INTEGER) ASC",
-            (start_val, end_val)
-        ).fetchall()
+        # Se compara con numero_caja (entero indexado), ya que id_caja
+        # se guarda como texto con relleno de ceros.
+        cajas = conn.execute(SQL_CAJAS_QR.format(filtro="cajas.numero_caja BETWEEN ? AND ?"),
+                             (start_val, end_val)).fetchall()
         conn.close()
         
-        # Asegurarse de que los códigos QR existan para cada caja
-        for caja in cajas:
-            qr_filename = os.path.join(QR_DIR, f"{caja['id_caja']}.png")
-            # Verificar si el archivo existe, si no existe o es muy antiguo, regenerarlo
-            if not os.path.exists(qr_filename):
-                qr_data = f"ID: {caja['id_caja']}\nCódigo: {caja['codigo_caja']}\nDepartamento: {caja['departamento']}\nTipo: {caja['tipo']}"
-                generate_qr_code(qr_data, qr_filename)
-                print(f"Generado QR para caja {caja['id_caja']}")
-                
-        return render_template("print_qr.html", cajas=cajas, start_range=start_range, end_range=end_range)
+        # Los QR que falten se generan en segundo plano; la página reintenta cargarlos
+        qr_archivos = preparar_qr_cajas(cajas)
+
+        return render_template("print_qr.html", cajas=cajas, qr_archivos=qr_archivos,
+                               start_range=start_range, end_range=end_range)
     # GET: Mostrar formulario para ingresar el rango.
-    return render_template("print_qr_form.html")
+    return render_template("print_qr_form.html", departamentos=get_departamentos(), papeles=PAPELES,
+                           columnas=app.config['ETIQUETAS_COLUMNAS'], filas=app.config['ETIQUETAS_FILAS'])
 
+@app.route("/etiquetas.pdf")
+@login_required
+def etiquetas_pdf():
+    """Hoja de etiquetas QR en PDF para un rango de cajas o un departamento."""
+    desde = request.args.get("desde", type=int)
+    hasta = request.args.get("hasta", type=int)
+    departamento_id = request.args.get("departamento", type=int)
+    if desde is None and hasta is None and departamento_id is None:
+        flash("Indique un rango de cajas o un departamento.")
+        return redirect(url_for("print_qr"))
+    papel = request.args.get("papel", app.config['ETIQUETAS_PAPEL'])
+    if papel not in PAPELES:
+        papel = app.config['ETIQUETAS_PAPEL']
+    columnas = min(max(request.args.get("columnas", app.config['ETIQUETAS_COLUMNAS'], type=int), 1), 6)
+    filas = min(max(request.args.get("filas", app.config['ETIQUETAS_FILAS'], type=int), 1), 20)
+
+    cajas = get_cajas_para_qr(desde, hasta, departamento_id)
+    if not cajas:
+        flash("No hay cajas para imprimir con esos criterios.")
+        return redirect(url_for("print_qr"))
+    etiquetas = [(datos_qr_caja(caja),
+                  [f"Caja {caja['id_caja']}", caja['departamento'] or '', caja['tipo'] or '', caja['codigo_caja'] or ''])
+                 for caja in cajas]
 
-@app.route("/cover/<int:caja_id>")
+    pdf = generar_pdf_etiquetas(etiquetas, papel=papel, columnas=columnas, filas=filas,
+                                margen_mm=app.config['ETIQUETAS_MARGEN_MM'], dpi=app.config['ETIQUETAS_DPI'],
+                                procesos=app.config['QR_PROCESOS'])
+    respuesta = Response(pdf, mimetype="application/pdf")
+    respuesta.headers["Content-Disposition"] = "attachment; filename=etiquetas_qr.pdf"
+    return respuesta
+
+
+@app.route("/qr/<id_caja>.<any(png, svg):formato>")
 @login_required
-def cover_caja(caja_id):
-    # 1. Obtener datos de la caja desde la base de datos
+def qr_imagen(id_caja, formato):
     conn = get_db_connection()
-    caja = conn.execute("""
-        SELECT cajas.*,
-               departamentos.nombre AS departamento,
-               tipos.nombre AS tipo,
-               bodegas.nombre AS bodega,
-               ubicaciones.nombre AS ubicacion
-        FROM cajas
-        LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id
-        LEFT JOIN tipos         ON cajas.tipo_id         = tipos.id
-        LEFT JOIN bodegas       ON cajas.bodega_id       = bodegas.id
-        LEFT JOIN ubicaciones   ON cajas.ubicacion_id    = ubicaciones.id
-        WHERE cajas.id = ?
-    """, (caja_id,)).fetchone()
+    caja = conn.execute(
+        "SELECT cajas.id_caja, cajas.codigo_caja, departamentos.nombre AS departamento, tipos.nombre AS tipo "
+        "FROM cajas "
+        "LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id "
+        "LEFT JOIN tipos ON cajas.tipo_id = tipos.id "
+        "WHERE cajas.id_caja = ?",
+        (id_caja,)
+    ).fetchone()
     conn.close()
+    if caja is None:
+        abort(404)
+
+    datos = datos_qr_caja(caja)
+    hash_contenido = hash_qr(datos)
+    respuesta = Response(get_qr_bytes(datos, hash_contenido, formato),
+                         mimetype="image/svg+xml" if formato == "svg" else "image/png")
+    respuesta.set_etag(f"{hash_contenido}-{formato}")
+    if request.args.get("v") == hash_contenido:
+        # La URL versionada cambia si cambia el contenido: el navegador no necesita revalidar.
+        # Es privada porque el QR incluye datos de la caja y la ruta requiere sesión.
+        respuesta.cache_control.private = True
+        respuesta.cache_control.max_age = 31536000
+        respuesta.cache_control.immutable = True
+    else:
+        respuesta.cache_control.no_cache = True
+    return respuesta.make_conditional(request)
 
-    if not caja:
+# ========================================================
+# Portadas de cajas (con caché de HTML renderizado)
+# ========================================================
+# Cada portada se guarda en portadas_cache junto con una clave que resume la fila
+# de la caja (incluidos los nombres de catálogo), la plantilla usada y su fecha de
+# modificación. Si nada de eso cambió, se reutiliza el HTML sin volver a renderizar.
+# Cada portada ocupa varios KB (la plantilla incluye su CSS), así que solo se guardan
+# las que se piden y la tabla se recorta a las PORTADAS_CACHE_ENTRADAS más recientes.
+
+SQL_CAJAS_PORTADA = """
+    SELECT cajas.*,
+           departamentos.nombre AS departamento,
+           tipos.nombre AS tipo,
+           bodegas.nombre AS bodega,
+           ubicaciones.nombre AS ubicacion
+    FROM cajas
+    LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id
+    LEFT JOIN tipos         ON cajas.tipo_id         = tipos.id
+    LEFT JOIN bodegas       ON cajas.bodega_id       = bodegas.id
+    LEFT JOIN ubicaciones   ON cajas.ubicacion_id    = ubicaciones.id
+    WHERE {filtro}
+    ORDER BY cajas.numero_caja ASC
+"""
+
+def get_cajas_portada(filtro, params):
+    conn = get_db_connection()
+    cajas = conn.execute(SQL_CAJAS_PORTADA.format(filtro=filtro), params).fetchall()
+    conn.close()
+    return cajas
+
+# Mapa nombre de departamento -> plantilla, calculado una vez y reutilizado mientras
+# no cambien los departamentos (versión del catálogo) ni el directorio cover/.
+_plantillas_portada = {'catalogo': None, 'fecha_directorio': None, 'disponibles': (), 'mapa': {}}
+_plantillas_portada_lock = threading.Lock()
+
+PLANTILLA_PORTADA_DEFECTO = "cover/default.html"
+# Plantillas de cover/ que no son portadas de una caja
+PLANTILLAS_NO_PORTADA = {"cover_department.html"}
+
+def _directorio_portadas():
+    return os.path.join(app.root_path, app.template_folder, "cover")
+
+def get_plantillas_portada():
+    """Devuelve (plantillas disponibles, mapa departamento -> plantilla), refrescándolos si hace falta."""
+    catalogo = get_catalogo("departamentos")
+    # Añadir, borrar o renombrar archivos cambia la fecha del directorio
+    fecha_directorio = os.stat(_directorio_portadas()).st_mtime_ns
+    with _plantillas_portada_lock:
+        if (_plantillas_portada['catalogo'] is catalogo
+                and _plantillas_portada['fecha_directorio'] == fecha_directorio):
+            return _plantillas_portada['disponibles'], _plantillas_portada['mapa']
+
+    disponibles = tuple(sorted(
+        archivo for archivo in os.listdir(_directorio_portadas())
+        if archivo.endswith(".html") and archivo not in PLANTILLAS_NO_PORTADA
+    ))
+    mapa = {}
+    for dep in catalogo.filas:
+        # Una plantilla asignada explícitamente tiene prioridad sobre la derivada del nombre
+        candidatos = [dep["cover_template"], dep["nombre"].lower().replace(" ", "_") + ".html"]
+        mapa[dep["nombre"]] = next((f"cover/{c}" for c in candidatos if c in disponibles),
+                                   PLANTILLA_PORTADA_DEFECTO)
+    with _plantillas_portada_lock:
+        _plantillas_portada.update(catalogo=catalogo, fecha_directorio=fecha_directorio,
+                                   disponibles=disponibles, mapa=mapa)
+    return disponibles, mapa
+
+def resolver_plantilla_portada(departamento):
+    """Plantilla de portada para un departamento, con una sola búsqueda en el mapa."""
+    _, mapa = get_plantillas_portada()
+    return mapa.get(departamento, PLANTILLA_PORTADA_DEFECTO)
+
+def opciones_plantilla_portada():
+    disponibles, _ = get_plantillas_portada()
+    return [("", "Automática (según el nombre del departamento)")] + [(p, p) for p in disponibles]
+
+def _fecha_plantilla(nombre):
+    return os.path.getmtime(os.path.join(app.root_path, app.template_folder, nombre))
+
+def renderizar_portadas(cajas):
+    """
+    Devuelve (portadas, renderizadas): el HTML de la portada de cada caja, en el
+    mismo orden, y cuántas hubo que renderizar de nuevo.
+
+    Las portadas guardadas se leen con una sola consulta; solo se renderizan (y se
+    guardan) las de cajas cuya fila, plantilla o URL del QR cambió. Las usadas se
+    marcan con la hora actual si su marca tiene más de PORTADAS_USO_REFRESCO_SEGUNDOS
+    y, si se guardó alguna nueva, se descartan las menos recientes que excedan
+    PORTADAS_CACHE_ENTRADAS. Las de esta llamada nunca se descartan: un departamento
+    con más cajas que el límite conserva todas sus portadas.
+    """
+    qr_archivos = preparar_qr_cajas(cajas)
+    plantillas = {}
+    claves = {}
+    for caja in cajas:
+        if caja['departamento'] not in plantillas:
+            nombre = resolver_plantilla_portada(caja['departamento'])
+            plantillas[caja['departamento']] = (nombre, _fecha_plantilla(nombre))
+        nombre, fecha = plantillas[caja['departamento']]
+        version = json.dumps([list(caja), nombre, fecha, qr_archivos[caja['id']]], default=str, ensure_ascii=False)
+        claves[caja['id']] = hashlib.sha256(version.encode('utf-8')).hexdigest()
+
+    conn = get_db_connection()
+    guardadas = {
+        fila['caja_id']: (fila['clave'], fila['html'], fila['usado'])
+        for fila in conn.execute(
+            "SELECT caja_id, clave, html, usado FROM portadas_cache WHERE caja_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(claves)),)
+        )
+    }
+    portadas = []
+    nuevas = []
+    reutilizadas = []
+    ahora = time.time()
+    limite_uso = ahora - app.config['PORTADAS_USO_REFRESCO_SEGUNDOS']
+    for caja in cajas:
+        clave = claves[caja['id']]
+        guardada = guardadas.get(caja['id'])
+        if guardada is not None and guardada[0] == clave:
+            portadas.append(guardada[1])
+            if guardada[2] < limite_uso:
+                reutilizadas.append(caja['id'])
+            continue
+        html = render_template(plantillas[caja['departamento']][0], caja=caja,
+                               qr_archivos={caja['id']: qr_archivos[caja['id']]})
+        portadas.append(html)
+        nuevas.append((caja['id'], clave, html, ahora))
+    if reutilizadas:
+        conn.execute("UPDATE portadas_cache SET usado = ? WHERE caja_id IN (SELECT value FROM json_each(?))",
+                     (ahora, json.dumps(reutilizadas)))
+    if nuevas:
+        conn.executemany(
+            "INSERT INTO portadas_cache (caja_id, clave, html, usado) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(caja_id) DO UPDATE SET clave = excluded.clave, html = excluded.html, usado = excluded.usado",
+            nuevas
+        )
+        # Se conservan las portadas de esta llamada y, del resto, las más recientes
+        # hasta completar el límite
+        conn.execute(
+            "DELETE FROM portadas_cache WHERE caja_id IN "
+            "(SELECT caja_id FROM portadas_cache WHERE caja_id NOT IN (SELECT value FROM json_each(?)) "
+            "ORDER BY usado DESC LIMIT -1 OFFSET ?)",
+            (json.dumps(list(claves)), max(app.config['PORTADAS_CACHE_ENTRADAS'] - len(claves), 0))
+        )
+    if reutilizadas or nuevas:
+        conn.commit()
+    conn.close()
+    return portadas, len(nuevas)
+
+@app.route("/cover/<int:caja_id>")
+@login_required
+def cover_caja(caja_id):
+    cajas = get_cajas_portada("cajas.id = ?", (caja_id,))
+    if not cajas:
         flash("Caja no encontrada.")
         return redirect(url_for("cajas"))
-        
-    # Asegurarse de que el código QR exista para esta caja
-    qr_filename = os.path.join(QR_DIR, f"{caja['id_caja']}.png")
-    # Verificar si el archivo existe, si no existe, regenerarlo
-    if not os.path.exists(qr_filename):
-        qr_data = f"ID: {caja['id_caja']}\nCódigo: {caja['codigo_caja']}\nDepartamento: {caja['departamento']}\nTipo: {caja['tipo']}"
-        generate_qr_code(qr_data, qr_filename)
-        print(f"Generado QR para caja {caja['id_caja']}")
-
-    # 2. Determinar la plantilla en base al nombre del departamento
-    #    - Reemplaza espacios por "_" y convierte a minúsculas para que coincida con tu archivo en cover/
-    dept_name = (caja["departamento"] or "default").lower().replace(" ", "_")
-    template_name = f"{dept_name}.html"  # Por ejemplo: "legal.html", "archivo_general.html", etc.
-
-    # 3. Renderizar la plantilla
-    try:
-        return render_template(f"cover/{template_name}", caja=caja)
-    except TemplateNotFound:
-        # Si no existe la plantilla específica, usamos la 'default.html'
-        return render_template("cover/default.html", caja=caja)
+
+    # Si falta el código QR se genera en segundo plano; la portada sale de la caché si no cambió
+    portadas, _ = renderizar_portadas(cajas)
+    return portadas[0]
 
 @app.route("/cover/department/<int:dep_id>")
 @login_required
 def cover_department(dep_id):
-    conn = get_db_connection()
     # Buscar todas las cajas de ese departamento
-    cajas = conn.execute("""
-        SELECT cajas.*,
-               departamentos.nombre AS departamento,
-               tipos.nombre AS tipo,
-               bodegas.nombre AS bodega,
-               ubicaciones.nombre AS ubicacion
-        FROM cajas
-        LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id
-        LEFT JOIN tipos         ON cajas.tipo_id         = tipos.id
-        LEFT JOIN bodegas       ON cajas.bodega_id       = bodegas.id
-        LEFT JOIN ubicaciones   ON cajas.ubicacion_id    = ubicaciones.id
-        WHERE departamentos.id = ?
-        ORDER BY CAST(cajas.id_caja AS INTEGER) ASC
-    """, (dep_id,)).fetchall()
-    
-    # Obtener el nombre del departamento para usar la plantilla específica
-    departamento_info = conn.execute("SELECT nombre FROM departamentos WHERE id = ?", (dep_id,)).fetchone()
-    conn.close()
-
+    cajas = get_cajas_portada("cajas.departamento_id = ?", (dep_id,))
     if not cajas:
         flash("No hay cajas en este departamento.")
         return redirect(url_for("cajas"))
-        
-    # Asegurarse de que los códigos QR existan para todas las cajas del departamento
-    for caja in cajas:
-        qr_filename = os.path.join(QR_DIR, f"{caja['id_caja']}.png")
-        # Verificar si el archivo existe, si no existe, regenerarlo
-        if not os.path.exists(qr_filename):
-            qr_data = f"ID: {caja['id_caja']}\nCódigo: {caja['codigo_caja']}\nDepartamento: {caja['departamento']}\nTipo: {caja['tipo']}"
-            generate_qr_code(qr_data, qr_filename)
-            print(f"Generado QR para caja {caja['id_caja']}")
-    
-    # Guardar el nombre del departamento para usar en la plantilla
-    dept_name = departamento_info['nombre'].lower().replace(' ', '_') if departamento_info else 'default'
-    
-    # Renderizar la plantilla cover_department.html que incluye la plantilla específica del departamento
-    # La plantilla cover_department.html ya tiene la lógica para intentar usar la plantilla del departamento
-    # o usar default.html si no existe
-    return render_template("cover/cover_department.html", cajas=cajas, dept_name=dept_name)
+
+    # Se unen las portadas guardadas y solo se renderizan las cajas que cambiaron
+    portadas, _ = renderizar_portadas(cajas)
+    return render_template("cover/cover_department.html", portadas=portadas)
 
 
 
@@ -1472,7 +3529,20 @@ def print_cover_caja():
     # Obtener cajas filtradas por el término de búsqueda
     conn = get_db_connection()
     
-    if search_term:
+    consulta_fts = construir_consulta_fts(search_term) if search_term else None
+    if consulta_fts:
+        # Búsqueda en el índice de texto completo, ordenada por relevancia
+        cajas = conn.execute("""
+            SELECT cajas.id, cajas.id_caja, departamentos.nombre AS departamento,
+                   tipos.nombre AS tipo, cajas.años, cajas.observacion, cajas.descripcion
+            FROM cajas_fts
+            JOIN cajas ON cajas.id = cajas_fts.rowid
+            LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id
+            LEFT JOIN tipos ON cajas.tipo_id = tipos.id
+            WHERE cajas_fts MATCH ?
+            ORDER BY cajas_fts.rank
+        """, (consulta_fts,)).fetchall()
+    elif search_term:
         # Búsqueda con filtro
         cajas = conn.execute("""
             SELECT cajas.id, cajas.id_caja, departamentos.nombre AS departamento,
@@ -1495,7 +3565,7 @@ def print_cover_caja():
             SELECT cajas.id, cajas.id_caja, departamentos.nombre AS departamento
             FROM cajas
         LEFT JOIN departamentos ON cajas.departamento_id = departamentos.id
-        ORDER BY CAST(cajas.id_caja AS INTEGER) ASC
+        ORDER BY cajas.numero_caja ASC
     """).fetchall()
     conn.close()
     
@@ -1519,10 +3589,475 @@ def print_cover_department():
     return render_template("print_cover_department.html", departamentos=departamentos)
 
 # ========================================================
-# Inicio del Scheduler y ejecución de la aplicación
+# Comandos de línea de comandos (flask <comando>)
+# ========================================================
+# Consultas frecuentes que deben resolverse con índices: (nombre, SQL, parámetros de ejemplo). Cada entrada usa la misma constante que la
+# función que la ejecuta, con filtros de ejemplo donde la consulta los recibe.
+_CURSOR_EJEMPLO = "c.numero_caja >= ? AND (c.numero_caja, c.id) > (?, ?)"
+CONSULTAS_FRECUENTES = [
+    ("reservar_numeros_caja", SQL_RESERVAR_NUMEROS, (0, 1)),
+    ("get_caja_by_id", SQL_CAJA_POR_ID, (1,)),
+    ("get_cajas_keyset (primera página)", SQL_LISTADO_CAJAS.format(filtro="1 AND 1", orden="c.numero_caja ASC, c.id ASC"),
+     (51, 0)),
+    ("get_cajas_keyset (cajas sin número)", SQL_LISTADO_CAJAS.format(
+        filtro="1 AND c.numero_caja IS NULL AND c.id > ?", orden="c.numero_caja ASC, c.id ASC"), (1, 51, 0)),
+    ("get_cajas_keyset (anteriores)", SQL_LISTADO_CAJAS.format(
+        filtro="1 AND c.numero_caja <= ? AND (c.numero_caja, c.id) < (?, ?)", orden="c.numero_caja DESC, c.id DESC"),
+     (1, 1, 1, 51, 0)),
+    ("get_cajas_keyset", SQL_LISTADO_CAJAS.format(
+        filtro=f"1 AND {_CURSOR_EJEMPLO}", orden="c.numero_caja ASC, c.id ASC"), (1, 1, 1, 51, 0)),
+    ("get_cajas_keyset (búsqueda FTS)", SQL_LISTADO_CAJAS.format(
+        filtro="c.id IN (SELECT rowid FROM cajas_fts WHERE cajas_fts MATCH ?) AND " + _CURSOR_EJEMPLO,
+        orden="c.numero_caja ASC, c.id ASC"), ('"caja"', 1, 1, 1, 51, 0)),
+    ("search_cajas (relevancia)", SQL_BUSQUEDA_FTS.format(orden="cajas_fts.rank, c.id"), ('"caja"', 50, 0)),
+    ("search_cajas (por número)", SQL_BUSQUEDA_FTS.format(orden="c.numero_caja, c.id"), ('"caja"', 50, 0)),
+    ("search_cajas_like", SQL_LISTADO_CAJAS.format(filtro=_filtro_like_cajas("ab")[0], orden="c.numero_caja, c.id"),
+     _filtro_like_cajas("ab")[1] + [50, 0]),
+    ("get_cajas_para_qr (id_caja)", SQL_CAJAS_QR.format(filtro="cajas.id_caja IN (SELECT value FROM json_each(?))"),
+     ('["00001"]',)),
+    ("print_qr", SQL_CAJAS_QR.format(filtro="cajas.numero_caja BETWEEN ? AND ?"), (1, 100)),
+    ("get_cajas_portada (departamento)", SQL_CAJAS_PORTADA.format(filtro="cajas.departamento_id = ?"), (1,)),
+    ("delete_caja (préstamos)", SQL_BORRAR_PRESTAMOS_CAJA, (0,)),
+    ("check_overdue_loans", SQL_PRESTAMOS_POR_AVISAR, ("2000-01-01",)),
+    ("get_prestamos_pagina (sin devolver)", SQL_PRESTAMOS_PAGINA.format(
+        filtro="p.returned = 0 AND p.id < ?", orden="DESC"), (1000, 51)),
+    ("get_prestamos_pagina (por fecha)", SQL_PRESTAMOS_PAGINA.format(
+        filtro="p.loan_date >= ? AND p.loan_date <= ? AND 1", orden="DESC"), ("2024-01-01", "2024-12-31", 51)),
+    ("contar_prestamos_vencidos", SQL_CONTAR_VENCIDOS, ("2000-01-01",)),
+    ("get_user_by_reset_token", SQL_USUARIO.format(columna="reset_token"), ("x",)),
+    ("get_user_by_username", SQL_USUARIO.format(columna="username"), ("x",)),
+    ("get_user_by_email", SQL_USUARIO.format(columna="email"), ("x",)),
+]
+
+def verificar_planes_consulta(conn):
+    """Ejecuta EXPLAIN QUERY PLAN sobre CONSULTAS_FRECUENTES y devuelve una lista
+    de (nombre, detalle) para cada paso que recorre una tabla completa.
+    Los planes se calculan sobre una copia vacía del esquema (sin estadísticas de
+    ANALYZE), para que el resultado no dependa de cuántas filas tenga la base."""
+    esquema = sqlite3.connect(":memory:")
+    esquema.row_factory = sqlite3.Row
+    for objeto in conn.execute("""
+        SELECT sql FROM sqlite_master
+        WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+          AND NOT (type = 'table' AND name LIKE 'cajas_fts_%')
+        ORDER BY rowid
+    """).fetchall():
+        esquema.execute(objeto["sql"])
+    problemas = []
+    for nombre, sql, params in CONSULTAS_FRECUENTES:
+        # Recorrer un índice en orden sí sirve cuando la consulta se corta con LIMIT
+        # (las páginas del listado); sin LIMIT equivale a leer la tabla entera.
+        con_limite = "LIMIT" in sql.upper()
+        for paso in esquema.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+            detalle = paso["detail"]
+            if not detalle.startswith("SCAN ") or "VIRTUAL TABLE" in detalle:
+                continue
+            if con_limite and " USING INDEX " in detalle:
+                continue
+            problemas.append((nombre, detalle))
+    esquema.close()
+    return problemas
+
+@app.cli.command("verificar-indices")
+def verificar_indices_command():
+    """Falla si alguna consulta frecuente hace un recorrido completo de tabla."""
+    conn = get_db_connection()
+    problemas = verificar_planes_consulta(conn)
+    conn.close()
+    for nombre, detalle in problemas:
+        click.echo(f"{nombre}: {detalle}")
+    if problemas:
+        raise click.ClickException(f"{len(problemas)} consultas sin índice")
+    click.echo(f"Las {len(CONSULTAS_FRECUENTES)} consultas frecuentes usan índices.")
+
+@app.cli.command("medir-sesiones")
+@click.option("--usuario", help="Usuario con el que se hacen las peticiones (por defecto, el primero).")
+@click.option("--ruta", default="/cajas", show_default=True, help="Ruta a pedir.")
+@click.option("--peticiones", default=300, show_default=True, help="Peticiones por medición.")
+def medir_sesiones_command(usuario, ruta, peticiones):
+    """Peticiones por segundo sobre una ruta autenticada, sin y con caché de usuarios."""
+    user = get_user_by_username(usuario) if usuario else None
+    if user is None:
+        conn = get_db_connection()
+        fila = conn.execute("SELECT * FROM users ORDER BY id LIMIT 1").fetchone()
+        conn.close()
+        if fila is None or usuario:
+            raise click.ClickException("No se encontró el usuario.")
+        user = _usuario_desde_fila(fila)
+    app.config['PLANIFICADOR_ACTIVO'] = False
+    cliente = app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion["_user_id"] = str(user.id)
+        sesion["_fresh"] = True
+    segundos_originales = app.config['USUARIOS_CACHE_SEGUNDOS']
+    resultados = {}
+    for nombre, segundos in (("sin caché", 0), ("con caché", segundos_originales or 60)):
+        app.config['USUARIOS_CACHE_SEGUNDOS'] = segundos
+        invalidar_usuario(user.id)
+        cliente.get(ruta)  # calentamiento
+        inicio = time.perf_counter()
+        for _ in range(peticiones):
+            respuesta = cliente.get(ruta)
+            if respuesta.status_code != 200:
+                raise click.ClickException(f"{ruta} respondió {respuesta.status_code}")
+        resultados[nombre] = peticiones / (time.perf_counter() - inicio)
+        click.echo(f"{nombre}: {resultados[nombre]:.0f} peticiones/s ({1000 / resultados[nombre]:.2f} ms por petición)")
+    app.config['USUARIOS_CACHE_SEGUNDOS'] = segundos_originales
+    click.echo(f"Mejora: {resultados['con caché'] / resultados['sin caché'] - 1:+.1%}")
+
+@app.cli.command("medir-claves")
+@click.option("--metodo", help="Método de hash a medir (por defecto, PASSWORD_METODO).")
+@click.option("--hilos", type=int, help="Hashes simultáneos (por defecto, PASSWORD_HILOS).")
+@click.option("--logins", default=60, show_default=True, help="Inicios de sesión simulados.")
+@click.option("--concurrencia", default=20, show_default=True, help="Peticiones que llegan a la vez.")
+def medir_claves_command(metodo, hilos, logins, concurrencia):
+    """Latencia de verificación de contraseñas ante una ráfaga de inicios de sesión."""
+    metodo = metodo or app.config['PASSWORD_METODO']
+    hilos = hilos or app.config['PASSWORD_HILOS']
+    hash_guardado = generate_password_hash("clave-de-prueba", metodo)
+    latencias = []
+    latencias_lock = threading.Lock()
+    # Mismo esquema que verificar_clave, con un pool propio del tamaño pedido
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        def peticion(cantidad):
+            for _ in range(cantidad):
+                inicio = time.perf_counter()
+                ejecutor.submit(check_password_hash, hash_guardado, "clave-de-prueba").result()
+                with latencias_lock:
+                    latencias.append(time.perf_counter() - inicio)
+
+        inicio = time.perf_counter()
+        peticiones = [threading.Thread(target=peticion, args=(logins // concurrencia + (i < logins % concurrencia),))
+                      for i in range(concurrencia)]
+        for hilo in peticiones:
+            hilo.start()
+        for hilo in peticiones:
+            hilo.join()
+        segundos = time.perf_counter() - inicio
+
+    latencias.sort()
+    def percentil(p):
+        return latencias[min(len(latencias) - 1, int(p / 100 * len(latencias)))] * 1000
+    click.echo(f"{metodo}, {hilos} hilos, {concurrencia} peticiones simultáneas: {len(latencias)} verificaciones "
+               f"en {segundos:.2f}s ({len(latencias) / segundos:.1f}/s)")
+    click.echo(f"p50 {percentil(50):.0f} ms, p95 {percentil(95):.0f} ms, p99 {percentil(99):.0f} ms")
+
+@app.cli.command("cajas-renumeradas")
+@click.option("--csv", "ruta_csv", type=click.Path(dir_okay=False, writable=True),
+              help="Guarda el listado en un CSV para imprimir las etiquetas nuevas.")
+def cajas_renumeradas_command(ruta_csv):
+    """Lista las cajas cuyo id_caja cambió al migrar la base."""
+    conn = get_db_connection()
+    filas = conn.execute("""
+        SELECT cajas_renumeradas.*, cajas.codigo_caja
+        FROM cajas_renumeradas LEFT JOIN cajas ON cajas.id = cajas_renumeradas.caja_id
+        ORDER BY cajas_renumeradas.caja_id
+    """).fetchall()
+    conn.close()
+    columnas = ["caja_id", "codigo_caja", "id_caja_anterior", "id_caja_nuevo", "motivo", "fecha"]
+    if ruta_csv:
+        with open(ruta_csv, "w", newline="", encoding="utf-8-sig") as f:
+            escritor = csv.writer(f)
+            escritor.writerow(columnas)
+            escritor.writerows([fila[c] for c in columnas] for fila in filas)
+    for fila in filas:
+        click.echo(f"Caja {fila['caja_id']} ({fila['codigo_caja']}): '{fila['id_caja_anterior']}' -> "
+                   f"'{fila['id_caja_nuevo']}' ({fila['motivo']}, {fila['fecha']})")
+    click.echo(f"{len(filas)} cajas renumeradas.")
+
+@app.cli.command("probar-secuencia")
+@click.option("--hilos", default=16, show_default=True, help="Hilos concurrentes.")
+@click.option("--reservas", default=200, show_default=True, help="Reservas por hilo.")
+@click.option("--bloque", default=5, show_default=True, help="Tamaño máximo de cada bloque reservado.")
+def probar_secuencia_command(hilos, reservas, bloque):
+    """Prueba de estrés de reservar_numeros_caja sobre una base temporal."""
+    directorio = tempfile.mkdtemp()
+    ruta = os.path.join(directorio, "secuencia.db")
+    conn = sqlite3.connect(ruta)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("CREATE TABLE cajas (id INTEGER PRIMARY KEY, numero_caja INTEGER UNIQUE)")
+    _migracion_secuencias(conn.cursor())
+    conn.commit()
+    conn.close()
+
+    numeros = []
+    errores = []
+    # Los bloques tienen tamaño aleatorio: cada hilo suma los números que pidió
+    esperados = [0]
+    numeros_lock = threading.Lock()
+
+    def trabajador(semilla):
+        try:
+            reservar(semilla)
+        except Exception as e:
+            with numeros_lock:
+                errores.append(f"hilo {semilla}: {e!r}")
+
+    def reservar(semilla):
+        azar = random.Random(semilla)
+        conn = sqlite3.connect(ruta, timeout=60)
+        propios = []
+        pedidos = 0
+        for i in range(reservas):
+            if i % 2:
+                # Como add_caja: reservar e insertar en la misma transacción
+                conn.execute("BEGIN IMMEDIATE")
+                numero = reservar_numeros_caja(conn)
+                conn.execute("INSERT INTO cajas (numero_caja) VALUES (?)", (numero,))
+                conn.commit()
+                propios.append(numero)
+                pedidos += 1
+            else:
+                # Como la importación: un bloque de varios números en una sola consulta
+                cantidad = azar.randint(1, bloque)
+                inicio = reservar_numeros_caja(conn, cantidad)
+                propios.extend(range(inicio, inicio + cantidad))
+                pedidos += cantidad
+        conn.close()
+        with numeros_lock:
+            numeros.extend(propios)
+            esperados[0] += pedidos
+
+    inicio = time.perf_counter()
+    hilos_activos = [threading.Thread(target=trabajador, args=(i,)) for i in range(hilos)]
+    for hilo in hilos_activos:
+        hilo.start()
+    for hilo in hilos_activos:
+        hilo.join()
+    segundos = time.perf_counter() - inicio
+
+    os.remove(ruta)
+    for sufijo in ("-wal", "-shm"):
+        if os.path.exists(ruta + sufijo):
+            os.remove(ruta + sufijo)
+    os.rmdir(directorio)
+
+    click.echo(f"{hilos * reservas} reservas, {len(numeros)} números en {segundos:.2f}s "
+               f"({hilos * reservas / segundos:.0f} reservas/s)")
+    if errores:
+        raise click.ClickException(f"{len(errores)} hilos fallaron: {'; '.join(errores[:5])}")
+    if len(numeros) != esperados[0]:
+        raise click.ClickException(f"Se pidieron {esperados[0]} números y se obtuvieron {len(numeros)}")
+    duplicados = len(numeros) - len(set(numeros))
+    if duplicados:
+        raise click.ClickException(f"{duplicados} números duplicados")
+    if numeros and max(numeros) - min(numeros) + 1 != len(numeros):
+        raise click.ClickException(f"Hay huecos: {len(numeros)} números entre {min(numeros)} y {max(numeros)}")
+    click.echo("Sin errores, duplicados ni huecos.")
+
+def _importar_en_base_temporal(ruta_db, archivo_path, tamano_lote):
+    """Importa archivo_path con procesar_excel_cajas sobre una base nueva en ruta_db,
+    con un registro 'Prueba' en cada catálogo. Devuelve (exito, mensaje, cajas)."""
+    configuracion = {clave: app.config[clave] for clave in ('DB_PATH', 'IMPORTACION_TAMANO_LOTE', 'QR_EN_MEMORIA')}
+    vaciar_pool()
+    app.config.update(DB_PATH=ruta_db, IMPORTACION_TAMANO_LOTE=tamano_lote, QR_EN_MEMORIA=True)
+    _cache_catalogos['version'] = None
+    try:
+        with app.app_context():
+            create_tables()
+            conn = get_db_connection()
+            for tabla in TABLAS_CATALOGO:
+                conn.execute(f"INSERT INTO {tabla} (nombre) VALUES ('Prueba')")
+            conn.commit()
+            exito, mensaje, _ = procesar_excel_cajas(archivo_path)
+            cajas = {fila['codigo_caja']: fila['id_caja'] for fila in conn.execute("SELECT codigo_caja, id_caja FROM cajas")}
+            conn.close()
+    finally:
+        vaciar_pool()
+        app.config.update(configuracion)
+        _cache_catalogos['version'] = None
+    return exito, mensaje, cajas
+
+@app.cli.command("probar-importacion")
+@click.option("--filas", default=2503, show_default=True, help="Filas del archivo de prueba.")
+@click.option("--lote", default=1000, show_default=True, help="Filas por lote.")
+def probar_importacion_command(filas, lote):
+    """Importa un archivo sintético por lotes sobre bases temporales y falla si se
+    rechaza alguna fila o el resultado difiere del de un solo lote.
+    Una de cada tres filas trae un id_caja explícito y las demás se numeran solas: los
+    números automáticos de un lote no deben chocar con los ids de lotes posteriores."""
+    directorio = tempfile.mkdtemp()
+    datos = pd.DataFrame({
+        'id_caja': pd.array([90000 + i if i % 3 == 0 else None for i in range(filas)], dtype='Int64'),
+        'codigo_caja': [f"P{i}" for i in range(filas)],
+        'Departamento': 'Prueba', 'Años': '2020', 'Tipo': 'Prueba', 'Bodega': 'Prueba',
+        'Ubicacion': 'Prueba', 'Percha': '1', 'Fila': '1', 'Columna': '1',
+    })
+    explicitos = {f"P{i}": str(90000 + i).zfill(5) for i in range(0, filas, 3)}
+    fallos = []
+    try:
+        for extension in ('csv', 'xlsx'):
+            archivo = os.path.join(directorio, f"cajas.{extension}")
+            if extension == 'csv':
+                datos.to_csv(archivo, index=False)
+            else:
+                datos.to_excel(archivo, index=False)
+            resultados = {}
+            for tamano in (lote, filas):
+                ruta_db = os.path.join(directorio, f"{extension}_{tamano}.db")
+                exito, mensaje, cajas = _importar_en_base_temporal(ruta_db, archivo, tamano)
+                resultados[tamano] = cajas
+                click.echo(f"{extension}, lotes de {tamano}: {mensaje}")
+                if not exito or len(cajas) != filas:
+                    fallos.append(f"{extension} en lotes de {tamano}: {len(cajas)} de {filas} filas importadas")
+                cambiados = [codigo for codigo, id_caja in explicitos.items() if cajas.get(codigo) != id_caja]
+                if cambiados:
+                    fallos.append(f"{extension} en lotes de {tamano}: {len(cambiados)} id_caja explícitos no se respetaron")
+            if set(resultados[lote]) != set(resultados[filas]):
+                fallos.append(f"{extension}: importar por lotes acepta otras filas que en un solo lote")
+    finally:
+        for entrada in os.scandir(directorio):
+            os.remove(entrada.path)
+        os.rmdir(directorio)
+    if fallos:
+        raise click.ClickException("; ".join(fallos))
+    click.echo("Importar por lotes acepta las mismas filas que en un solo lote.")
+
+# ========================================================
+# Tareas de mantenimiento del planificador
+# ========================================================
+def precalentar_portadas(departamento_id=None):
+    """Renderiza las portadas que no estén en portadas_cache. Devuelve (cajas, renderizadas).
+    La caché guarda como mucho PORTADAS_CACHE_ENTRADAS portadas, así que conviene
+    usarla para un departamento que se va a imprimir, no para todas las cajas."""
+    if departamento_id is None:
+        filtro, params = "1", ()
+    else:
+        filtro, params = "cajas.departamento_id = ?", (departamento_id,)
+    # Las plantillas usan url_for, que necesita un contexto de petición
+    with app.test_request_context("/"):
+        cajas = get_cajas_portada(filtro, params)
+        renderizadas = 0
+        for i in range(0, len(cajas), 500):
+            _, nuevas = renderizar_portadas(cajas[i:i + 500])
+            renderizadas += nuevas
+    return len(cajas), renderizadas
+
+def precalentar_qr():
+    """Genera los archivos QR que falten o estén desactualizados (solo si se sirven desde archivos)."""
+    if app.config['QR_EN_MEMORIA']:
+        return "QR servidos desde memoria; nada que generar"
+    resultado = generar_qr_cajas(get_cajas_para_qr())
+    return f"{resultado['generados']} generados, {resultado['omitidos']} al día"
+
+def limpiar_datos_antiguos():
+    """Borra subidas huérfanas, avisos ya enviados de hace más de 90 días y
+    trabajos terminados de hace más de 30."""
+    borrados = 0
+    limite_archivos = time.time() - 24 * 3600
+    for entrada in os.scandir(app.config['UPLOAD_FOLDER']):
+        # Las importaciones borran su archivo al terminar; lo que queda es de un proceso caído
+        if entrada.is_file() and entrada.stat().st_mtime < limite_archivos:
+            os.remove(entrada.path)
+            borrados += 1
+    hoy = datetime.datetime.now()
+    conn = get_db_connection()
+    avisos = conn.execute("DELETE FROM outbox WHERE estado = 'enviado' AND enviado < ?",
+                          ((hoy - datetime.timedelta(days=90)).isoformat(timespec="seconds"),)).rowcount
+    trabajos = conn.execute("DELETE FROM trabajos WHERE estado IN ('completado', 'error', 'cancelado') AND actualizado < ?",
+                            ((hoy - datetime.timedelta(days=30)).isoformat(timespec="seconds"),)).rowcount
+    conn.commit()
+    conn.close()
+    return f"{borrados} archivos, {avisos} avisos y {trabajos} trabajos borrados"
+
+def optimizar_indice_busqueda():
+    """Fusiona los segmentos de cajas_fts en uno solo."""
+    if not FTS_DISPONIBLE:
+        return "FTS no disponible"
+    conn = get_db_connection()
+    conn.execute("INSERT INTO cajas_fts (cajas_fts) VALUES ('optimize')")
+    conn.commit()
+    conn.close()
+
+def analizar_base():
+    """Actualiza las estadísticas del planificador de consultas de SQLite."""
+    conn = get_db_connection()
+    conn.execute("PRAGMA optimize")
+    conn.close()
+
+def compactar_base():
+    """VACUUM de la base y truncado del WAL."""
+    conn = get_db_connection()
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+registrar_tarea("avisos_vencidos", notify_overdue_loans, "Avisos de préstamos vencidos", a_las="09:00")
+registrar_tarea("outbox", entregar_outbox, "Reintento de avisos pendientes", cada=10 * 60)
+registrar_tarea("qr", precalentar_qr, "Generar códigos QR pendientes", a_las="02:30")
+registrar_tarea("limpieza", limpiar_datos_antiguos, "Limpieza de subidas, avisos y trabajos antiguos", a_las="03:00")
+registrar_tarea("fts_optimize", optimizar_indice_busqueda, "Optimizar índice de búsqueda", a_las="03:30", dias=7)
+registrar_tarea("analyze", analizar_base, "ANALYZE (PRAGMA optimize)", a_las="04:00")
+registrar_tarea("vacuum", compactar_base, "VACUUM de la base", a_las="04:30", dias=7)
+
+@app.route("/admin/jobs")
+@login_required
+def admin_jobs():
+    estado = get_estado_tareas()
+    tareas = []
+    for nombre, tarea in _tareas.items():
+        fila = estado[nombre]
+        tareas.append({
+            "nombre": nombre,
+            "descripcion": tarea.descripcion,
+            "frecuencia": describir_frecuencia(tarea),
+            "ultima": fila["ultima_ejecucion"] if fila else None,
+            "duracion": fila["duracion"] if fila else None,
+            "resultado": fila["resultado"] if fila else None,
+            "error": fila["ultimo_error"] if fila else None,
+            "ejecuciones": fila["ejecuciones"] if fila else 0,
+            "proxima": proxima_ejecucion(tarea, fila["ultima_ejecucion"] if fila else None).isoformat(timespec="seconds"),
+        })
+    tareas.sort(key=lambda t: t["proxima"])
+    conn = get_db_connection()
+    lider = conn.execute("SELECT duenio, vence FROM arrendamientos WHERE nombre = 'planificador'").fetchone()
+    conn.close()
+    if lider and lider["vence"] < time.time():
+        lider = None
+    return render_template("admin_jobs.html", tareas=tareas, lider=lider, proceso=id_proceso())
+
+@app.cli.command("ejecutar-tarea")
+@click.argument("nombre", type=click.Choice(sorted(_tareas)))
+def ejecutar_tarea_command(nombre):
+    """Ejecuta ahora una tarea del planificador y registra el resultado."""
+    ejecutar_tarea(nombre)
+    fila = get_estado_tareas()[nombre]
+    click.echo(f"{nombre}: {fila['duracion']:.2f}s; {fila['ultimo_error'] or fila['resultado'] or 'ok'}")
+
+@app.cli.command("precalentar-portadas")
+@click.option("--departamento", "departamento_id", type=int, help="ID del departamento (por defecto, todos).")
+def precalentar_portadas_command(departamento_id):
+    """Renderiza y guarda por adelantado las portadas de un departamento."""
+    inicio = time.perf_counter()
+    cajas, renderizadas = precalentar_portadas(departamento_id)
+    click.echo(f"{cajas} portadas: {renderizadas} renderizadas, {cajas - renderizadas} ya al día "
+               f"({time.perf_counter() - inicio:.2f}s)")
+
+@app.cli.command("notificar-vencidos")
+def notificar_vencidos_command():
+    """Envía ahora los avisos de préstamos vencidos (lo mismo que la tarea de las 09:00)."""
+    notify_overdue_loans()
+
+@app.cli.command("generar-qr")
+@click.option("--desde", type=int, help="Número de caja inicial.")
+@click.option("--hasta", type=int, help="Número de caja final.")
+@click.option("--departamento", "departamento_id", type=int, help="ID del departamento.")
+@click.option("--procesos", type=int, help="Procesos a usar (por defecto, uno por CPU).")
+@click.option("--forzar", is_flag=True, help="Regenera también los QR que ya existen.")
+def generar_qr_command(desde, hasta, departamento_id, procesos, forzar):
+    """Genera los códigos QR de un rango de cajas o de un departamento."""
+    cajas = get_cajas_para_qr(desde, hasta, departamento_id)
+    if procesos:
+        app.config['QR_PROCESOS'] = procesos
+    resultado = generar_qr_cajas(cajas, forzar=forzar)
+    click.echo(f"{len(cajas)} cajas: {resultado['generados']} QR generados, {resultado['omitidos']} al día, "
+               f"{resultado['segundos']:.2f}s ({resultado['qr_por_segundo']:.0f} QR/s)")
+
+# ========================================================
+# Inicio del planificador y ejecución de la aplicación
 # ========================================================
 def run_app():
-    start_scheduler_thread()
+    iniciar_planificador()
     app.run(debug=True, port=8000, host='0.0.0.0')
 
 if __name__ == "__main__":
@@ -0,0 +1,292 @@
+"""
+Generación de códigos QR por lotes y de hojas de etiquetas en PDF.
+
+Este módulo no importa la aplicación Flask ni abre la base de datos. Con
+'flask run' o un servidor WSGI, los procesos del pool solo cargan este módulo. Con
+'python app.py', en cambio, 'spawn' vuelve a ejecutar app.py en cada proceso como
+__mp_main__: app.py lo detecta (PROCESO_AUXILIAR) y omite la creación de tablas,
+las migraciones y la revisión de trabajos, aunque el resto del módulo se carga.
+"""
+import os
+import time
+import json
+import hashlib
+import zlib
+from io import BytesIO
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import qrcode
+import qrcode.image.svg
+from PIL import Image, ImageDraw, ImageFont
+
+# Parámetros de codificación; forman parte del hash, así que cambiarlos invalida
+# todos los QR existentes sin tener que borrar archivos a mano.
+QR_PARAMETROS = {
+    'error_correction': 'M',
+    'box_size': 10,
+    'border': 4,
+    'formato': 'png',
+}
+
+_NIVELES_CORRECCION = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+
+# Por debajo de este tamaño no compensa repartir el trabajo entre procesos
+MIN_TAREAS_PARALELO = 16
+
+_pool = None
+_pool_procesos = None
+_pool_lock = threading.Lock()
+
+
+def hash_qr(data):
+    """Hash determinista del contenido del QR y sus parámetros de codificación."""
+    clave = json.dumps({'datos': data, **QR_PARAMETROS}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(clave.encode('utf-8')).hexdigest()[:32]
+
+
+def _crear_qr(data):
+    qr = qrcode.QRCode(error_correction=_NIVELES_CORRECCION[QR_PARAMETROS['error_correction']],
+                       box_size=QR_PARAMETROS['box_size'], border=QR_PARAMETROS['border'])
+    qr.add_data(data)
+    return qr
+
+
+def codificar_qr(data, formato="png"):
+    """Genera un código QR en memoria y devuelve sus bytes ('png' o 'svg')."""
+    qr = _crear_qr(data)
+    buffer = BytesIO()
+    if formato == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    else:
+        qr.make_image().save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def generar_qr(data, filename):
+    """Genera un único código QR y lo guarda en filename."""
+    datos = codificar_qr(data)
+    # Se escribe en un temporal y se renombra para que nunca se sirva un PNG a medias
+    temporal = f"{filename}.{os.getpid()}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(datos)
+    os.replace(temporal, filename)
+    return filename
+
+
+def _generar_tarea(tarea):
+    data, filename = tarea
+    return generar_qr(data, filename)
+
+
+def qr_al_dia(filename):
+    """
+    Un QR se considera al día si el archivo existe y no está vacío: el nombre es
+    el hash del contenido, así que un archivo existente nunca está obsoleto.
+    """
+    try:
+        return os.path.getsize(filename) > 0
+    except OSError:
+        return False
+
+
+def _obtener_pool(procesos):
+    global _pool, _pool_procesos
+    with _pool_lock:
+        if _pool is None or _pool_procesos != procesos:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # 'spawn' evita heredar por fork los hilos y conexiones del servidor
+            _pool = ProcessPoolExecutor(max_workers=procesos,
+                                        mp_context=multiprocessing.get_context("spawn"))
+            _pool_procesos = procesos
+        return _pool
+
+
+def generar_lote(tareas, procesos=None, forzar=False):
+    """
+    Genera los códigos QR de una lista de (datos, archivo) repartiéndolos entre procesos.
+
+    Omite los archivos que ya están al día salvo que forzar sea True. Devuelve un
+    diccionario con generados, omitidos, segundos y qr_por_segundo.
+    """
+    inicio = time.perf_counter()
+    tareas = list(tareas)
+    pendientes = tareas if forzar else [t for t in tareas if not qr_al_dia(t[1])]
+    procesos = procesos or os.cpu_count() or 1
+
+    if len(pendientes) < MIN_TAREAS_PARALELO or procesos == 1:
+        for tarea in pendientes:
+            _generar_tarea(tarea)
+    else:
+        # Trozos grandes para que el coste de comunicación entre procesos no domine
+        chunksize = max(1, len(pendientes) // (procesos * 4))
+        for _ in _obtener_pool(procesos).map(_generar_tarea, pendientes, chunksize=chunksize):
+            pass
+
+    segundos = time.perf_counter() - inicio
+    return {
+        'generados': len(pendientes),
+        'omitidos': len(tareas) - len(pendientes),
+        'segundos': segundos,
+        'qr_por_segundo': len(pendientes) / segundos if segundos > 0 and pendientes else 0.0,
+    }
+
+
+# ========================================================
+# Hojas de etiquetas en PDF
+# ========================================================
+# Cada página se dibuja con Pillow en un proceso del pool y vuelve ya comprimida;
+# el proceso principal solo va escribiendo los objetos PDF, así que el documento
+# se puede enviar mientras se generan las páginas siguientes.
+
+# Tamaños de papel en milímetros (ancho, alto)
+PAPELES = {
+    'A4': (210.0, 297.0),
+    'Letter': (215.9, 279.4),
+}
+
+_MM_POR_PULGADA = 25.4
+
+
+def _fuente(tamano):
+    try:
+        return ImageFont.load_default(size=tamano)
+    except (TypeError, ImportError):
+        # Pillow sin FreeType: solo hay fuente de mapa de bits de tamaño fijo
+        return ImageFont.load_default()
+
+
+def _recortar_texto(dibujo, texto, fuente, ancho):
+    if dibujo.textlength(texto, font=fuente) <= ancho:
+        return texto
+    # Búsqueda binaria del prefijo más largo que cabe junto con los puntos suspensivos
+    bajo, alto = 0, len(texto)
+    while bajo < alto:
+        medio = (bajo + alto + 1) // 2
+        if dibujo.textlength(texto[:medio] + "…", font=fuente) <= ancho:
+            bajo = medio
+        else:
+            alto = medio - 1
+    return texto[:bajo] + "…"
+
+
+def _imagen_qr(datos, lado):
+    """QR en escala de grises de lado x lado píxeles, armado desde la matriz de módulos."""
+    matriz = _crear_qr(datos).get_matrix()
+    modulos = len(matriz)
+    pixeles = bytes(0 if modulo else 255 for fila in matriz for modulo in fila)
+    return Image.frombytes("L", (modulos, modulos), pixeles).resize((lado, lado), Image.NEAREST)
+
+
+def renderizar_pagina_etiquetas(pagina):
+    """
+    Dibuja una página de etiquetas y devuelve (ancho_px, alto_px, bytes comprimidos).
+
+    pagina es (etiquetas, disposicion); cada etiqueta es (datos_qr, lineas de texto)
+    y disposicion es el diccionario que arma generar_pdf_etiquetas.
+    """
+    etiquetas, disposicion = pagina
+    dpi = disposicion['dpi']
+    px = lambda mm: int(round(mm * dpi / _MM_POR_PULGADA))
+    ancho_papel, alto_papel = PAPELES[disposicion['papel']]
+    imagen = Image.new("L", (px(ancho_papel), px(alto_papel)), 255)
+    dibujo = ImageDraw.Draw(imagen)
+
+    margen = px(disposicion['margen_mm'])
+    columnas, filas = disposicion['columnas'], disposicion['filas']
+    ancho_celda = (imagen.width - 2 * margen) // columnas
+    alto_celda = (imagen.height - 2 * margen) // filas
+    relleno = max(2, ancho_celda // 30)
+    lado_qr = min(alto_celda - 2 * relleno, ancho_celda // 2)
+    fuente_titulo = _fuente(max(8, alto_celda // 7))
+    fuente_texto = _fuente(max(6, alto_celda // 10))
+
+    for posicion, (datos, lineas) in enumerate(etiquetas):
+        x = margen + (posicion % columnas) * ancho_celda
+        y = margen + (posicion // columnas) * alto_celda
+        if disposicion['bordes']:
+            dibujo.rectangle([x, y, x + ancho_celda - 1, y + alto_celda - 1], outline=160)
+        imagen.paste(_imagen_qr(datos, lado_qr), (x + relleno, y + (alto_celda - lado_qr) // 2))
+
+        texto_x = x + 2 * relleno + lado_qr
+        ancho_texto = ancho_celda - lado_qr - 3 * relleno
+        texto_y = y + relleno * 2
+        for numero, linea in enumerate(lineas):
+            fuente = fuente_titulo if numero == 0 else fuente_texto
+            dibujo.text((texto_x, texto_y), _recortar_texto(dibujo, linea, fuente, ancho_texto), font=fuente, fill=0)
+            texto_y += int(fuente.size * 1.3) if hasattr(fuente, 'size') else 14
+
+    return imagen.width, imagen.height, zlib.compress(imagen.tobytes(), 6)
+
+
+def generar_pdf_etiquetas(etiquetas, papel='A4', columnas=3, filas=8, margen_mm=8.0,
+                          dpi=200, bordes=True, procesos=None):
+    """
+    Genera un PDF de varias páginas con las etiquetas indicadas, en trozos de bytes.
+
+    Las páginas se reparten entre procesos y se escriben en orden a medida que
+    terminan, de modo que la descarga empieza antes de tener el documento completo.
+    """
+    disposicion = {'papel': papel, 'columnas': columnas, 'filas': filas,
+                   'margen_mm': margen_mm, 'dpi': dpi, 'bordes': bordes}
+    por_pagina = columnas * filas
+    etiquetas = list(etiquetas)
+    paginas = [(etiquetas[i:i + por_pagina], disposicion) for i in range(0, len(etiquetas), por_pagina)]
+    if not paginas:
+        paginas = [([], disposicion)]
+
+    procesos = procesos or os.cpu_count() or 1
+    if len(paginas) == 1 or procesos == 1:
+        renderizadas = map(renderizar_pagina_etiquetas, paginas)
+    else:
+        renderizadas = _obtener_pool(procesos).map(renderizar_pagina_etiquetas, paginas)
+
+    ancho_pt, alto_pt = (mm * 72 / _MM_POR_PULGADA for mm in PAPELES[papel])
+    desplazamientos = {}
+    escrito = 0
+
+    def objeto(numero, contenido, flujo=None):
+        nonlocal escrito
+        desplazamientos[numero] = escrito
+        partes = [f"{numero} 0 obj\n".encode(), contenido.encode()]
+        if flujo is not None:
+            partes += [b"\nstream\n", flujo, b"\nendstream"]
+        partes.append(b"\nendobj\n")
+        datos = b"".join(partes)
+        escrito += len(datos)
+        return datos
+
+    cabecera = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    escrito = len(cabecera)
+    yield cabecera
+
+    # 1 = catálogo, 2 = árbol de páginas; cada página usa tres objetos a partir del 3
+    hijos = []
+    for indice, (ancho_px, alto_px, comprimido) in enumerate(renderizadas):
+        pagina, contenido, imagen = 3 + 3 * indice, 4 + 3 * indice, 5 + 3 * indice
+        hijos.append(f"{pagina} 0 R")
+        dibujar = f"q {ancho_pt:.2f} 0 0 {alto_pt:.2f} 0 0 cm /Im0 Do Q".encode()
+        yield (
+            objeto(pagina, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {ancho_pt:.2f} {alto_pt:.2f}] "
+                           f"/Resources << /XObject << /Im0 {imagen} 0 R >> >> /Contents {contenido} 0 R >>")
+            + objeto(contenido, f"<< /Length {len(dibujar)} >>", dibujar)
+            + objeto(imagen, f"<< /Type /XObject /Subtype /Image /Width {ancho_px} /Height {alto_px} "
+                             f"/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode "
+                             f"/Length {len(comprimido)} >>", comprimido)
+        )
+
+    final = objeto(2, f"<< /Type /Pages /Kids [{' '.join(hijos)}] /Count {len(hijos)} >>")
+    final += objeto(1, "<< /Type /Catalog /Pages 2 0 R >>")
+    inicio_xref = escrito
+    total = max(desplazamientos) + 1
+    xref = [f"xref\n0 {total}\n", "0000000000 65535 f \n"]
+    xref += [f"{desplazamientos[numero]:010d} 00000 n \n" for numero in range(1, total)]
+    xref.append(f"trailer\n<< /Size {total} /Root 1 0 R >>\nstartxref\n{inicio_xref}\n%%EOF\n")
+    yield final + "".join(xref).encode()